@@ -0,0 +1,220 @@
+"""Metrics and tracing of the requests made to the Google APIs.
+
+Every HTTP round trip made by the services built by google_services.py
+(including batches, media downloads, and the chunks of resumable
+uploads) is recorded with its API method, status, latency, bytes sent
+and received, and whether it retries a failed request.  The records can
+be written as a JSON-lines trace, summarized at the end of a run (p50 and
+p95 latency per method, calls per student, throughput), and exported in
+the Prometheus textfile format, so that runs started by cron can be graphed.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+from googleapiclient.http import HttpRequest
+
+# Maximum number of failed requests remembered, to recognize their retries.
+_MAX_FAILED = 10000
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+class ApiMetrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {} # method -> {'latencies', 'errors', 'retries', 'sent', 'received'}
+        self.failed = set()
+        self.trace = None
+        self.time_start = time.time()
+        # Number of students of the run, set by the tools, for the calls per student.
+        self.students = None
+
+    def open_trace(self, trace_file):
+        """Starts writing each request as a line of JSON to trace_file."""
+        self.trace = open(trace_file, 'a', buffering=1)
+
+    def close(self):
+        with self.lock:
+            if self.trace is not None:
+                self.trace.close()
+                self.trace = None
+
+    def record(self, method, latency, status, sent=0, received=0, key=None):
+        """Records a request of method that took latency seconds and got the
+        HTTP status (0 if there was no response).  Requests with the same
+        key following a failure are counted as retries."""
+        error = status == 0 or status >= 400
+        with self.lock:
+            retry = key is not None and key in self.failed
+            if error and key is not None and len(self.failed) < _MAX_FAILED:
+                self.failed.add(key)
+            elif key is not None:
+                self.failed.discard(key)
+            m = self.methods.get(method)
+            if m is None:
+                m = self.methods[method] = {'latencies': [], 'errors': 0, 'retries': 0,
+                                            'sent': 0, 'received': 0}
+            m['latencies'].append(latency)
+            m['errors'] += error
+            m['retries'] += retry
+            m['sent'] += sent
+            m['received'] += received
+            if self.trace is not None:
+                self.trace.write(json.dumps({
+                    'time': round(time.time(), 3), 'method': method, 'status': status,
+                    'latency_ms': round(latency * 1000, 1), 'sent': sent, 'received': received,
+                    'retry': retry, 'thread': threading.current_thread().name}) + "\n")
+
+    def summary(self, num_students=None):
+        """Returns a summary of the requests, one line per method."""
+        elapsed = max(time.time() - self.time_start, 1e-9)
+        lines = [f"{'method':38s} {'calls':>6s} {'errors':>6s} {'retries':>7s} "
+                 f"{'p50_ms':>8s} {'p95_ms':>8s} {'MB':>8s} {'MB/s':>7s}"
+                 + (f" {'calls/student':>13s}" if num_students else "")]
+        total_calls, total_bytes = 0, 0
+        with self.lock:
+            for method, m in sorted(self.methods.items()):
+                latencies = sorted(m['latencies'])
+                n = len(latencies)
+                mb = (m['sent'] + m['received']) / 1e6
+                # The throughput while requests of this method are in progress.
+                busy = sum(latencies)
+                line = (f"{method:38s} {n:6d} {m['errors']:6d} {m['retries']:7d} "
+                        f"{percentile(latencies, 0.5) * 1000:8.1f} "
+                        f"{percentile(latencies, 0.95) * 1000:8.1f} {mb:8.2f} "
+                        f"{mb / busy if busy else 0:7.2f}")
+                if num_students:
+                    line += f" {n / num_students:13.2f}"
+                lines.append(line)
+                total_calls += n
+                total_bytes += m['sent'] + m['received']
+        line = (f"{total_calls} requests in {elapsed:.1f}s, {total_calls / elapsed:.1f} requests/s, "
+                f"{total_bytes / 1e6:.2f} MB, {total_bytes / 1e6 / elapsed:.2f} MB/s")
+        if num_students:
+            line += f", {total_calls / num_students:.2f} requests per student"
+        lines.append(line)
+        return "\n".join(lines)
+
+    def write_prometheus(self, prometheus_file, tool, num_students=None):
+        """Writes the metrics in the Prometheus textfile format."""
+        prefix = 'class_tools'
+        labels = f'tool="{tool}"'
+        out = []
+        def metric(name, kind, help_text, values):
+            out.append(f"# HELP {prefix}_{name} {help_text}")
+            out.append(f"# TYPE {prefix}_{name} {kind}")
+            for extra, value in values:
+                out.append(f"{prefix}_{name}{{{labels}{extra}}} {value}")
+        with self.lock:
+            methods = sorted(self.methods.items())
+            metric('api_requests_total', 'counter', "Requests made to the Google APIs.",
+                   [(f',method="{k}"', len(m['latencies'])) for k, m in methods])
+            metric('api_errors_total', 'counter', "Requests that failed.",
+                   [(f',method="{k}"', m['errors']) for k, m in methods])
+            metric('api_retries_total', 'counter', "Requests retrying a failed one.",
+                   [(f',method="{k}"', m['retries']) for k, m in methods])
+            metric('api_sent_bytes_total', 'counter', "Bytes sent.",
+                   [(f',method="{k}"', m['sent']) for k, m in methods])
+            metric('api_received_bytes_total', 'counter', "Bytes received.",
+                   [(f',method="{k}"', m['received']) for k, m in methods])
+            latency_values = []
+            for k, m in methods:
+                latencies = sorted(m['latencies'])
+                for q in (0.5, 0.95):
+                    latency_values.append((f',method="{k}",quantile="{q}"',
+                                           f"{percentile(latencies, q):.6f}"))
+            metric('api_latency_seconds', 'summary', "Latency of the requests.", latency_values)
+            out.extend(f"{prefix}_api_latency_seconds_sum{{{labels},method=\"{k}\"}} "
+                       f"{sum(m['latencies']):.6f}" for k, m in methods)
+            out.extend(f"{prefix}_api_latency_seconds_count{{{labels},method=\"{k}\"}} "
+                       f"{len(m['latencies'])}" for k, m in methods)
+        metric('run_duration_seconds', 'gauge', "Duration of the last run.",
+               [('', f"{time.time() - self.time_start:.3f}")])
+        metric('run_timestamp_seconds', 'gauge', "End time of the last run.",
+               [('', f"{time.time():.0f}")])
+        if num_students is not None:
+            metric('run_students', 'gauge', "Students processed in the last run.",
+                   [('', num_students)])
+        # Written atomically, as the collector may read it at any time.
+        tmp_fn = prometheus_file + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            f.write("\n".join(out) + "\n")
+        os.replace(tmp_fn, prometheus_file)
+
+
+metrics = ApiMetrics()
+
+
+class TracedHttp(object):
+    """Wraps the http object of a request, recording each round trip."""
+
+    def __init__(self, http, method):
+        self.http = http
+        self.method = method
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        name = self.method
+        parsed = urlparse(uri)
+        if parsed.path.startswith('/batch'):
+            name = 'batch'
+        elif 'alt=media' in parsed.query:
+            name += '_media'
+        sent = int((headers or {}).get('content-length', 0) or 0)
+        if not sent and isinstance(body, (bytes, str)):
+            sent = len(body)
+        t0 = time.time()
+        try:
+            resp, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+        except Exception:
+            metrics.record(name, time.time() - t0, 0, sent=sent, key=(method, uri))
+            raise
+        metrics.record(name, time.time() - t0, resp.status, sent=sent,
+                       received=len(content or b''), key=(method, uri))
+        return resp, content
+
+
+class TracedRequest(HttpRequest):
+    """Request whose round trips are recorded in the metrics; it is given
+    as requestBuilder when building the services."""
+
+    def __init__(self, http, *args, **kwargs):
+        super().__init__(http, *args, **kwargs)
+        self.http = TracedHttp(http, self.methodId or 'unknown')
+
+
+def add_arguments(parser):
+    """Adds to an argparse parser the options controlling the metrics."""
+    parser.add_argument('--trace', type=str, default=None,
+                        help="Append a JSON line for each API request to this file.")
+    parser.add_argument('--metrics', action='store_true', default=False,
+                        help="Print a summary of the API requests at the end.")
+    parser.add_argument('--prometheus', type=str, default=None,
+                        help="Write the API metrics to this file, in the Prometheus "
+                        "textfile format.")
+
+
+def start(args):
+    """Starts the tracing requested by the options."""
+    if args.trace:
+        metrics.open_trace(args.trace)
+
+
+def finish(args):
+    """Outputs the metrics requested by the options."""
+    metrics.close()
+    if args.metrics:
+        print(metrics.summary(metrics.students))
+    if args.prometheus:
+        tool = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        metrics.write_prometheus(args.prometheus, tool, metrics.students)
@@ -0,0 +1,91 @@
+"""Measures grading throughput on synthetic submissions.
+
+Generates N student directories, named student<i>@bench.invalid, as copies
+of a template submission (typically the solution of the assignment), and
+grades them serially and with different numbers of parallel workers,
+reporting the throughput of each mode.  Usage:
+
+python benchmark_grading.py -g ../assignment1-source/grade -t ../assignment1-source -n 50 -w 0,2,4
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import grade_submissions
+
+
+def make_submissions(template_dir, bench_dir, n):
+    """Creates n copies of template_dir in bench_dir, returning their names."""
+    students = []
+    for i in range(n):
+        student_dir = f"student{i:04d}@bench.invalid"
+        shutil.copytree(template_dir, os.path.join(bench_dir, student_dir),
+                        ignore=shutil.ignore_patterns('__pycache__', '.git'))
+        students.append(student_dir)
+    return students
+
+
+def mean(values):
+    values = [v for v in values if v is not None]
+    return sum(values) / len(values) if values else float('nan')
+
+
+def main(args):
+    _, import_timing = grade_submissions.measure(grade_submissions.load_grader, args.grade_file)
+    print(f"Grader import: {import_timing['wall_s']:.3f}s")
+    bench_dir = args.dir or tempfile.mkdtemp(prefix='grading_bench_')
+    os.makedirs(bench_dir, exist_ok=True)
+    try:
+        students = make_submissions(args.template_dir, bench_dir, args.num_students)
+        print(f"Generated {len(students)} submissions in {bench_dir}")
+        print(f"{'workers':>8s} {'total_s':>9s} {'students/s':>11s} {'speedup':>8s} "
+              f"{'wall_s':>8s} {'cpu_s':>8s} {'rss_mb':>8s} {'failed':>7s}")
+        baseline = None
+        for workers in [int(w) for w in args.workers.split(',')]:
+            grading_args = argparse.Namespace(
+                grade_file=args.grade_file, assignment_dir=bench_dir, workers=workers,
+                timeout=args.timeout, memory_limit=None, cprofile_dir=None,
+                pool=args.pool, recycle_after=args.recycle_after, recycle_mb=None)
+            t0 = time.time()
+            results, timings = grade_submissions.grade_students(
+                grading_args, students, verbose=False)
+            total = time.time() - t0
+            baseline = baseline or total
+            failed = sum(1 for _, reason, _ in results.values() if reason)
+            print(f"{workers:8d} {total:9.2f} {len(students) / total:11.2f} "
+                  f"{baseline / total:8.2f} "
+                  f"{mean(t['wall_s'] for t in timings.values()):8.3f} "
+                  f"{mean(t['cpu_s'] for t in timings.values()):8.3f} "
+                  f"{mean(t['peak_rss_mb'] for t in timings.values()):8.1f} {failed:7d}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(bench_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-g', '--grade_file', required=True,
+                        help="grade.py file to use for grading (without the .py).")
+    parser.add_argument('-t', '--template_dir', required=True,
+                        help="Submission to copy for each synthetic student.")
+    parser.add_argument('-n', '--num_students', type=int, default=20,
+                        help="Number of synthetic students.")
+    parser.add_argument('-w', '--workers', type=str, default='0,2,4',
+                        help="Comma-separated list of worker counts to try; 0 means "
+                        "grading serially in this process.")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="Wall-clock time limit, in seconds, to grade each submission.")
+    parser.add_argument('--pool', action='store_true', default=False,
+                        help="Grade in warm worker processes, which import the grader once.")
+    parser.add_argument('--recycle_after', type=int, default=50,
+                        help="With --pool, replace each worker after this many submissions.")
+    parser.add_argument('--dir', type=str, default=None,
+                        help="Directory where to generate the submissions (default: a "
+                        "temporary directory).")
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help="Keep the generated submissions.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,297 @@
+"""Content-addressed store for the files of extracted submissions.
+
+Most of the files of a submission are the same for every student (the
+starter code), and for every regrade.  When a store is used, identical
+files take space only once: each extracted file is replaced by a
+copy-on-write clone (reflink) of a blob named after the sha256 of its
+content, so that a student file can be modified without affecting the
+others.  On file systems without reflinks (such as ext4), files are
+instead hard links to the blob, made read-only, and grade_submissions.py
+replaces them with private copies before grading a student, as graders
+write into the submissions, and as root ignores the read-only mode.
+The store also remembers the digest of each file, so that the grade
+cache does not need to hash the files again.
+
+To see how much space is saved, and to remove the blobs that are no
+longer used by any submission, run:
+
+python blob_store.py <store_dir> [--gc]
+"""
+
+import argparse
+import errno
+import os
+import shutil
+import sqlite3
+import stat
+import threading
+
+from grade_cache import IGNORED_DIRS, IGNORED_EXTENSIONS, hash_file
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; files are then hard linked.
+    fcntl = None
+
+INDEX_NAME = 'index.sqlite'
+# ioctl that clones a file on Linux file systems with reflinks (btrfs, xfs).
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """Creates dst as a copy-on-write clone of src, raising OSError if the
+    file system does not support it."""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported")
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        try:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        except OSError:
+            f_dst.close()
+            os.unlink(dst)
+            raise
+
+
+def supports_reflinks(dir_path):
+    """Returns True if files in dir_path can be cloned."""
+    src = os.path.join(dir_path, '.reflink_test.%d.tmp' % os.getpid())
+    dst = src + '.clone'
+    with open(src, 'wb') as f:
+        f.write(b'reflink')
+    try:
+        clone_file(src, dst)
+        os.unlink(dst)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.unlink(src)
+
+
+class BlobStore(object):
+
+    def __init__(self, store_dir):
+        """Opens (creating it if needed) the store in store_dir."""
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.reflinks = supports_reflinks(store_dir)
+        self.lock = threading.Lock()
+        # Totals of the add_tree calls on this object.
+        self.stats = {'files': 0, 'bytes': 0, 'dup_files': 0, 'dup_bytes': 0}
+        self.db = sqlite3.connect(os.path.join(store_dir, INDEX_NAME),
+                                  check_same_thread=False)
+        # The files sharing the content of a blob, identified as they were
+        # when they were added, so that files modified since are recognized.
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER,
+            mtime_ns INTEGER, name TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_inode ON files (ino, dev)")
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    def blob_path(self, name):
+        return os.path.join(self.store_dir, name[:2], name)
+
+    def _record(self, path, name):
+        st = os.stat(path)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                            (os.path.abspath(path), st.st_dev, st.st_ino, st.st_size,
+                             st.st_mtime_ns, name))
+            self.db.commit()
+
+    def add(self, path):
+        """Replaces the file at path with a clone of, or a link to, the blob
+        with the same content, creating the blob if needed.  Returns True
+        if the blob already existed, that is, if the file took no extra space."""
+        st = os.stat(path)
+        digest = hash_file(path)
+        # Executable and non-executable files cannot share the same blob.
+        name = digest + ('.x' if st.st_mode & stat.S_IXUSR else '')
+        blob_path = self.blob_path(name)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        tmp_path = path + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+        mode = stat.S_IMODE(st.st_mode)
+        try:
+            if self.reflinks:
+                existed = os.path.exists(blob_path)
+                if not existed:
+                    # The blob is a clone of the file, which stays as it is.
+                    clone_file(path, tmp_path)
+                    os.chmod(tmp_path, mode & ~0o222)
+                    try:
+                        os.link(tmp_path, blob_path)
+                    except FileExistsError:
+                        existed = True
+                    os.unlink(tmp_path)
+                if existed:
+                    clone_file(blob_path, tmp_path)
+                    os.chmod(tmp_path, mode)
+                    os.replace(tmp_path, path)
+            else:
+                try:
+                    os.chmod(path, mode & ~0o222)
+                    os.link(path, blob_path)
+                    existed = False
+                except FileExistsError:
+                    # Another file has the same content: links it in place of this one.
+                    os.link(blob_path, tmp_path)
+                    os.replace(tmp_path, path)
+                    existed = True
+        except OSError:
+            # Typically, the store is on another file system; keeps the file as it is.
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            os.chmod(path, mode)
+            return False
+        self._record(path, name)
+        return existed
+
+    def add_tree(self, root_dir):
+        """Adds all the files of a directory tree to the store.  Returns
+        the number of files and of bytes, and how many of these were
+        already in the store."""
+        stats = {'files': 0, 'bytes': 0, 'dup_files': 0, 'dup_bytes': 0}
+        for path in self._tree_files(root_dir):
+            size = os.path.getsize(path)
+            stats['files'] += 1
+            stats['bytes'] += size
+            if self.add(path):
+                stats['dup_files'] += 1
+                stats['dup_bytes'] += size
+        with self.lock:
+            for key, value in stats.items():
+                self.stats[key] += value
+        return stats
+
+    @staticmethod
+    def _tree_files(root_dir):
+        for root, dirs, files in os.walk(root_dir):
+            dirs[:] = [d for d in dirs if d not in IGNORED_DIRS]
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                if file_name.endswith(IGNORED_EXTENSIONS) or not os.path.isfile(path) \
+                        or os.path.islink(path):
+                    continue
+                yield path
+
+    def unshare_tree(self, root_dir):
+        """Replaces the files of a directory tree that are hard links to
+        blobs with private, writable copies, so that they can be modified
+        without affecting the blobs and the other submissions.  Returns the
+        number of files copied."""
+        copied = 0
+        for path in self._tree_files(root_dir):
+            st = os.stat(path)
+            if st.st_nlink < 2:
+                continue
+            name = self._name_of(st)
+            if name is None:
+                continue
+            tmp_path = path + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+            shutil.copyfile(path, tmp_path)
+            os.chmod(tmp_path, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+            os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(tmp_path, path)
+            # The copy still has the content of the blob.
+            self._record(path, name)
+            copied += 1
+        return copied
+
+    def _name_of(self, st):
+        """Returns the name of the blob whose content the file of os.stat st
+        has, if the file is unchanged since it was added, and None otherwise."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT name FROM files WHERE ino = ? AND dev = ? AND size = ? AND mtime_ns = ?",
+                (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns)).fetchone()
+        return None if row is None else row[0]
+
+    def digest_of(self, st):
+        """Returns the sha256 of a file, given its os.stat, if the file has
+        the content of a blob, and None otherwise."""
+        name = self._name_of(st)
+        return None if name is None else name.split('.')[0]
+
+    def _blobs(self):
+        """Yields the name and os.stat of each blob."""
+        for prefix in os.scandir(self.store_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if not entry.name.endswith('.tmp'):
+                    yield entry.name, entry.stat()
+
+    def _live_files(self):
+        """Returns the files recorded in the store that still exist, unchanged,
+        as a list of (path, size, blob name); forgets the others."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path, dev, ino, size, mtime_ns, name FROM files").fetchall()
+        live, dead = [], []
+        for path, dev, ino, size, mtime_ns, name in rows:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is not None and (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) == (
+                    dev, ino, size, mtime_ns):
+                live.append((path, size, name))
+            else:
+                dead.append((path,))
+        with self.lock:
+            self.db.executemany("DELETE FROM files WHERE path = ?", dead)
+            self.db.commit()
+        return live
+
+    def report(self):
+        """Returns the number of blobs, of files sharing their content, of
+        bytes stored, and of bytes that the files would take without the store."""
+        report = {'blobs': 0, 'files': 0, 'stored_bytes': 0, 'logical_bytes': 0, 'unused': 0}
+        used = set()
+        for _, size, name in self._live_files():
+            report['files'] += 1
+            report['logical_bytes'] += size
+            used.add(name)
+        for name, st in self._blobs():
+            report['blobs'] += 1
+            report['stored_bytes'] += st.st_size
+            report['unused'] += 0 if name in used else 1
+        return report
+
+    def gc(self):
+        """Removes the blobs that no file shares, returning how many."""
+        used = {name for _, _, name in self._live_files()}
+        removed = 0
+        for name, st in self._blobs():
+            if name not in used:
+                os.unlink(self.blob_path(name))
+                removed += 1
+        return removed
+
+
+def format_report(report):
+    saved = report['logical_bytes'] - report['stored_bytes']
+    ratio = report['logical_bytes'] / report['stored_bytes'] if report['stored_bytes'] else 1.0
+    return (f"{report['files']} files in {report['blobs']} blobs "
+            f"({report['unused']} unused): {report['stored_bytes'] / 1e6:.1f} MB stored "
+            f"for {report['logical_bytes'] / 1e6:.1f} MB of files, dedup ratio {ratio:.2f}, "
+            f"{saved / 1e6:.1f} MB saved")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store_dir', help="Directory of the store.")
+    parser.add_argument('--gc', action='store_true', default=False,
+                        help="Remove the blobs that are no longer used.")
+    args = parser.parse_args()
+    store = BlobStore(args.store_dir)
+    if args.gc:
+        print(f"Removed {store.gc()} unused blobs")
+    print(format_report(store.report()))
+    store.close()
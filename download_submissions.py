@@ -3,103 +3,457 @@
 
 import argparse
 import csv
+import fnmatch
+import json
 import os
-import pickle
+import re
 import shutil
+import sys
+import tempfile
+import threading
 import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
 
+import api_metrics
+from blob_store import BlobStore, format_report
+from google_services import (BATCH_SIZE, backoff_sleep, build_service, get_credentials,
+                             print_timing, thread_service)
+from sheet_reader import SheetReader
+
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly',
             'https://www.googleapis.com/auth/drive.readonly']
 # https://www.googleapis.com/auth/spreadsheets for r/w
 #
 
+# How the submissions that are not 'ok' are reported, by status.
+STATUS_MESSAGES = {
+    'too_large': "Too large to download",
+    'download_error': "Errors in downloading",
+    'unzip_error': "Errors in unzipping",
+}
+# HTTP statuses that are worth retrying: rate limiting and server errors.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 6
+# Name of the file, in the destination directory, recording what has been downloaded.
+MANIFEST_NAME = '.manifest.json'
+# Name of the file, in the destination directory, recording which rows of the
+# sheet have been read.
+SHEET_STATE_NAME = '.sheet_state.json'
+# Metadata used to decide whether and how to download each submission.
+METADATA_FIELDS = 'id, name, mimeType, size, md5Checksum, modifiedTime'
+# Google Docs, Sheets, etc. cannot be downloaded, only exported; these are
+# the default export formats of each type.
+GOOGLE_MIME_PREFIX = 'application/vnd.google-apps.'
+DEFAULT_EXPORT_FORMATS = {
+    'application/vnd.google-apps.document': 'pdf',
+    'application/vnd.google-apps.spreadsheet': 'xlsx',
+    'application/vnd.google-apps.presentation': 'pdf',
+    'application/vnd.google-apps.drawing': 'pdf',
+}
+EXPORT_MIME_TYPES = {
+    'pdf': 'application/pdf',
+    'txt': 'text/plain',
+    'html': 'text/html',
+    'csv': 'text/csv',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'odt': 'application/vnd.oasis.opendocument.text',
+    'ods': 'application/vnd.oasis.opendocument.spreadsheet',
+    'png': 'image/png',
+}
+_DRIVE_PATH_ID = re.compile(r'/(?:d|folders)/([A-Za-z0-9_-]+)')
 
-def main(args):
-    creds = None
-    # The file token.pickle stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
+
+def is_retriable(e):
+    """Returns True if the HttpError e is transient and can be retried."""
+    return isinstance(e, HttpError) and e.resp.status in RETRY_STATUSES
+
+
+def parse_docid(url):
+    """Returns the Drive file id in a submission url, which can be of the
+    form .../open?id=<id>, .../file/d/<id>/view, or just the id."""
+    url = url.strip()
+    parsed = urlparse(url)
+    if not parsed.netloc:
+        return url
+    ids = parse_qs(parsed.query).get('id')
+    if ids:
+        return ids[0]
+    m = _DRIVE_PATH_ID.search(parsed.path)
+    if m:
+        return m.group(1)
+    return url.rstrip('/').split('/')[-1]
+
+
+def download_plan(meta, args):
+    """Returns how to download a file given its metadata (None if unknown):
+    as (extension, export_mime, unzip), where export_mime is the type to
+    which Google-native files are exported, and None for other files."""
+    mime = (meta or {}).get('mimeType') or ''
+    if mime.startswith(GOOGLE_MIME_PREFIX):
+        export_format = getattr(args, 'export_format', None) or DEFAULT_EXPORT_FORMATS.get(mime, 'pdf')
+        return export_format, EXPORT_MIME_TYPES.get(export_format, export_format), False
+    return args.extension, None, not args.no_unzip and args.extension == 'zip'
+
+
+def too_large(meta, args):
+    """Returns True if the file of metadata meta exceeds args.max_download_mb.
+    The size of Google-native files is not known, but Drive limits their export."""
+    max_mb = getattr(args, 'max_download_mb', None)
+    return max_mb is not None and meta is not None and int(meta.get('size') or 0) > max_mb * 1e6
+
+
+class Progress(object):
+    """Thread-safe combined progress line for concurrent downloads."""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.active = 0
+        self.skipped = 0
+        self.num_bytes = 0
+        self.time0 = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, started=0, finished=0, num_bytes=0, skipped=0):
+        """Records that downloads started or finished, that num_bytes were
+        downloaded, or that submissions were skipped without downloading;
+        these count as done."""
+        with self.lock:
+            self.active += started - finished
+            self.done += finished + skipped
+            self.skipped += skipped
+            self.num_bytes += num_bytes
+            elapsed = time.time() - self.time0
+            sys.stdout.write("\rDownloaded %d/%d (%d active, %d skipped), %.1f MB, %.1fs" % (
+                self.done, self.total, self.active, self.skipped, self.num_bytes / 1e6,
+                elapsed))
+            sys.stdout.flush()
+
+    def message(self, msg):
+        """Prints a message without garbling the progress line."""
+        with self.lock:
+            sys.stdout.write("\r" + msg + "\n")
+            sys.stdout.flush()
+
+
+class DriveWorkers(object):
+    """Hands out one Drive service per thread, as httplib2 is not thread-safe."""
+
+    def __init__(self, creds):
+        self.creds = creds
+
+    def service(self):
+        return thread_service('drive', 'v3', self.creds)
+
+
+def download_file(drive_service, docid, f, name, progress, export_mime=None):
+    """Downloads the Drive file docid into the file object f, retrying
+    transient errors, exporting it to export_mime if given.
+    name is used in messages."""
+    attempt = 0
+    while True:
+        try:
+            f.seek(0)
+            f.truncate()
+            if export_mime is not None:
+                request = drive_service.files().export_media(fileId=docid, mimeType=export_mime)
+            else:
+                request = drive_service.files().get_media(fileId=docid)
+            downloader = MediaIoBaseDownload(f, request)
+            done = False
+            downloaded = 0
+            while done is False:
+                status, done = downloader.next_chunk()
+                progress.update(num_bytes=status.resumable_progress - downloaded)
+                downloaded = status.resumable_progress
+            return
+        except HttpError as e:
+            if not is_retriable(e) or attempt >= MAX_RETRIES:
+                raise
+            attempt += 1
+            progress.message(f"Retrying {name} after HTTP {e.resp.status} (attempt {attempt})")
+            backoff_sleep(attempt)
+
+
+def is_wanted(path, include, exclude):
+    """Checks whether a path in a zip file should be extracted, given
+    lists of include and exclude glob patterns.  A pattern matches if it
+    matches the whole path, or any of its components."""
+    parts = [p for p in path.split('/') if p]
+    def matches(pattern):
+        return fnmatch.fnmatch(path, pattern) or any(fnmatch.fnmatch(p, pattern) for p in parts)
+    if exclude and any(matches(pattern) for pattern in exclude):
+        return False
+    return not include or any(matches(pattern) for pattern in include)
+
+
+def extract_zip(f, student_dir, include=None, exclude=None, max_size=None):
+    """Extracts the zip file f (a file name or object) into student_dir,
+    keeping only the wanted files.  Raises ValueError if the uncompressed
+    size of the wanted files exceeds max_size bytes."""
+    with zipfile.ZipFile(f, 'r') as zip_ref:
+        members = [info for info in zip_ref.infolist()
+                   if is_wanted(info.filename, include, exclude)]
+        # Reading a member never yields more than its declared size,
+        # so checking the declared sizes guards against zip bombs.
+        total_size = sum(info.file_size for info in members)
+        if max_size is not None and total_size > max_size:
+            raise ValueError(f"uncompressed size {total_size} exceeds the limit of {max_size} bytes")
+        for info in members:
+            zip_ref.extract(info, student_dir)
+
+
+def load_manifest(destination_dir):
+    """Loads the manifest of previous downloads, mapping each email to
+    the docid, md5Checksum, modifiedTime and status of its submission."""
+    manifest_fn = os.path.join(destination_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_fn):
+        return {}
+    try:
+        with open(manifest_fn, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        print(f"Ignoring corrupted manifest {manifest_fn}")
+        return {}
+
+
+def save_manifest(destination_dir, manifest):
+    """Writes the manifest atomically, so an interrupted run does not corrupt it."""
+    manifest_fn = os.path.join(destination_dir, MANIFEST_NAME)
+    tmp_fn = manifest_fn + '.tmp'
+    with open(tmp_fn, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_fn, manifest_fn)
+
+
+def fetch_metadata(drive_service, docids):
+    """Fetches the metadata (METADATA_FIELDS) of the given docids, using
+    batch requests, and retrying the requests, and the batches, that fail
+    transiently.  Returns a dictionary from docid to metadata; files whose
+    metadata could not be read are omitted, so they are downloaded."""
+    metadata = {}
+    retry = []
+    def callback(request_id, response, exception):
+        if exception is None:
+            metadata[request_id] = response
+        elif is_retriable(exception):
+            retry.append(request_id)
+    todo = sorted(set(docids))
+    attempt = 0
+    while todo:
+        for i in range(0, len(todo), BATCH_SIZE):
+            batch = drive_service.new_batch_http_request(callback=callback)
+            chunk = todo[i:i + BATCH_SIZE]
+            for docid in chunk:
+                batch.add(drive_service.files().get(fileId=docid, fields=METADATA_FIELDS),
+                          request_id=docid)
             try:
-                creds.refresh(Request())
-            except:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    'credentials.json', SCOPES)
-                creds = flow.run_local_server()
+                batch.execute()
+            except HttpError as e:
+                if not is_retriable(e):
+                    print(f"Could not read the metadata of {len(chunk)} submissions: {e}")
+                    continue
+                retry.extend(docid for docid in chunk if docid not in metadata)
+        todo, retry = sorted(set(retry)), []
+        if todo:
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                break
+            backoff_sleep(attempt)
+    return metadata
+
+
+def is_unchanged(entry, docid, meta, args):
+    """Checks whether a manifest entry is still up to date with respect
+    to the Drive metadata meta of the submission docid."""
+    if entry is None or meta is None or entry.get('status') != 'ok':
+        return False
+    extension, _, unzip = download_plan(meta, args)
+    if entry.get('docid') != docid or entry.get('extension') != extension:
+        return False
+    if entry.get('md5Checksum') != meta.get('md5Checksum'):
+        return False
+    if entry.get('modifiedTime') != meta.get('modifiedTime'):
+        return False
+    # The downloaded files must still be there, in the form we want.
+    if entry.get('unzipped') != unzip:
+        return False
+    if unzip:
+        return os.path.isdir(os.path.join(args.destination_dir, entry['email']))
+    return os.path.exists(os.path.join(args.destination_dir, entry['email'] + '.' + extension))
+
+
+def process_submission(workers, email, docid, args, progress, store=None, meta=None):
+    """Downloads and unzips the submission of one student, adding its
+    files to the BlobStore store if given.  meta is the metadata of the
+    submission, if known: Google-native files are then exported, and
+    files that are too large are not downloaded.
+    Returns 'ok' if the submission is fine, 'too_large' if it is too
+    large, 'download_error' or 'unzip_error' if it could not be
+    downloaded or unzipped."""
+    extension, export_mime, unzip = download_plan(meta, args)
+    student_dir = os.path.join(args.destination_dir, email)
+    download_fn = os.path.join(args.destination_dir, email + '.' + extension)
+    # Removes previous files.
+    if os.path.exists(download_fn):
+        os.unlink(download_fn)
+    if os.path.exists(student_dir):
+        shutil.rmtree(student_dir)
+    if too_large(meta, args):
+        progress.message(f"Not downloading the submission of {email}: "
+                         f"{int(meta['size']) / 1e6:.1f} MB is too large")
+        progress.update(skipped=1)
+        return 'too_large'
+    progress.update(started=1)
+    max_size = None if args.max_unzipped_mb is None else int(args.max_unzipped_mb * 1e6)
+    status = 'ok'
+    try:
+        if unzip and args.stream:
+            # Downloads into a buffer, which stays in memory unless it is large.
+            with tempfile.SpooledTemporaryFile(max_size=int(args.spool_mb * 1e6)) as f:
+                download_file(workers.service(), docid, f, email, progress)
+                try:
+                    extract_zip(f, student_dir, args.include, args.exclude, max_size)
+                except Exception as e:
+                    status = 'unzip_error'
+                    progress.message(f"Error unzipping submission of {email}: {e}")
         else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server()
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-
-    sheet_service = build('sheets', 'v4', credentials=creds)
-    drive_service = build('drive', 'v3', credentials=creds)
-
-    # Call the Sheets API
-    range_name = args.sheet + '!' + args.email_column + '2:' + args.file_column
-    sheet = sheet_service.spreadsheets()
-    result = sheet.values().get(spreadsheetId=args.spreadsheet_id,
-                                range=range_name).execute()
-    values = result.get('values', [])
-
-    if not values:
-        print('No data found.')
-        return
+            with open(download_fn, 'wb') as f:
+                download_file(workers.service(), docid, f, download_fn, progress,
+                              export_mime=export_mime)
+            if unzip:
+                try:
+                    extract_zip(download_fn, student_dir, args.include, args.exclude, max_size)
+                    os.remove(download_fn)
+                except Exception as e:
+                    status = 'unzip_error'
+                    progress.message(f"Error unzipping {download_fn}: {e}")
+                    os.unlink(download_fn)
+    except Exception as e:
+        progress.message(f"Error downloading {email}: {e}")
+        status = 'download_error'
+    # Does not leave partial downloads or extractions around.
+    if status == 'download_error' and os.path.exists(download_fn):
+        os.unlink(download_fn)
+    if status != 'ok' and os.path.exists(student_dir):
+        shutil.rmtree(student_dir)
+    if status == 'ok' and unzip and store is not None:
+        store.add_tree(student_dir)
+    progress.update(finished=1)
+    return status
 
-    # Now downloads all the submissions.
-    student_submissions = {row[0]: row[-1] for row in values}
-    bad_files = []
+
+def read_submissions(sheet_service, args):
+    """Reads the submissions from the spreadsheet, returning a dictionary
+    from student email to submission url, restricted to args.students
+    if given.  Only the email and file columns are read; if
+    args.incremental, only the rows added since the previous run are
+    read, and merged with the submissions seen then."""
+    reader = SheetReader(sheet_service, args.spreadsheet_id, args.sheet)
+    state_fn = os.path.join(args.destination_dir, SHEET_STATE_NAME)
+    source = [args.spreadsheet_id, args.sheet, args.email_column, args.file_column]
+    state = {'next_row': 2, 'submissions': {}}
+    if getattr(args, 'incremental', False) and os.path.exists(state_fn):
+        with open(state_fn, 'r') as f:
+            saved_state = json.load(f)
+        # The state is only valid for the same sheet and columns.
+        if saved_state.get('source') == source:
+            state = saved_state
+    rows = reader.read_columns([args.email_column, args.file_column],
+                               first_row=state['next_row'])
+    student_submissions = state['submissions']
+    # Later responses override earlier ones.
+    for row_number, (email, url) in rows:
+        if email and url:
+            student_submissions[email] = url
+    if rows:
+        state = {'next_row': rows[-1][0] + 1, 'submissions': student_submissions,
+                 'source': source}
+        os.makedirs(args.destination_dir, exist_ok=True)
+        with open(state_fn + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(state_fn + '.tmp', state_fn)
     if args.students is not None:
         students = args.students.split(',')
         student_submissions = {k: v for k, v in student_submissions.items() if k in students}
-    for email, url in student_submissions.items():
-        if args.test:
+    return student_submissions
+
+
+def main(args):
+    creds = get_credentials(SCOPES)
+
+    sheet_service = build_service('sheets', 'v4', creds)
+    if args.timing:
+        print_timing()
+    student_submissions = read_submissions(sheet_service, args)
+    api_metrics.metrics.students = len(student_submissions)
+    if not student_submissions:
+        print('No data found.')
+        return
+
+    # Now downloads all the submissions.
+    bad_files = {} # status -> emails
+    if args.test:
+        for email, url in student_submissions.items():
             print(email, url)
-            continue
-        docid = url.split("=")[-1]
-        student_dir = os.path.join(args.destination_dir, email)
-        download_fn = os.path.join(args.destination_dir, email + '.' + args.extension)
+    else:
         # Creates the directory if necessary.
         if not os.path.exists(args.destination_dir):
             os.makedirs(args.destination_dir)
-        # Removes previous files.
-        if os.path.exists(download_fn):
-            os.unlink(download_fn)
-        if os.path.exists(student_dir):
-            shutil.rmtree(student_dir)
-        time0 = time.time()
-        with open(download_fn, 'wb') as f:
-            request = drive_service.files().get_media(fileId=docid)
-            downloader = MediaIoBaseDownload(f, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-                print("Download %s to %s : %d%% %.1fs" % (email, download_fn, int(status.progress() * 100), time.time() - time0))
-        if not args.no_unzip: 
-            try:
-                if args.extension == 'zip':
-                    with zipfile.ZipFile(download_fn, 'r') as zip_ref:
-                        extraction_dir = os.path.join(args.destination_dir, email)
-                        zip_ref.extractall(extraction_dir)
-                    os.remove(download_fn)
-            except Exception as e:
-                bad_files.append(email)
-                print(f"Error unzipping {download_fn}: {e}")
-                os.unlink(download_fn)
+        workers = DriveWorkers(creds)
+        docids = {email: parse_docid(url) for email, url in student_submissions.items()}
+        # Determines which submissions are new or changed since the last run.
+        manifest = {} if args.force else load_manifest(args.destination_dir)
+        metadata = fetch_metadata(workers.service(), docids.values())
+        to_download = {email: docid for email, docid in docids.items()
+                       if args.force or not is_unchanged(
+                           manifest.get(email), docid, metadata.get(docid), args)}
+        for email in to_download:
+            # Removes the previous download, if it was in another format.
+            old_extension = manifest.get(email, {}).get('extension')
+            old_fn = os.path.join(args.destination_dir, f"{email}.{old_extension}")
+            if old_extension and os.path.isfile(old_fn):
+                os.unlink(old_fn)
+        if len(to_download) < len(docids):
+            print(f"Skipping {len(docids) - len(to_download)} unchanged submissions.")
+        progress = Progress(len(to_download))
+        store = BlobStore(args.store) if args.store else None
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            futures = {email: pool.submit(process_submission, workers, email, docid, args,
+                                          progress, store, metadata.get(docid))
+                       for email, docid in to_download.items()}
+        print()
+        if store is not None:
+            stats = store.stats
+            print(f"Stored {stats['files']} files, {stats['bytes'] / 1e6:.1f} MB, of which "
+                  f"{stats['dup_files']} files, {stats['dup_bytes'] / 1e6:.1f} MB, were duplicates.")
+            print(format_report(store.report()))
+            store.close()
+        for email, future in futures.items():
+            meta = metadata.get(docids[email], {})
+            extension, _, unzip = download_plan(meta, args)
+            manifest[email] = {
+                'email': email,
+                'docid': docids[email],
+                'md5Checksum': meta.get('md5Checksum'),
+                'modifiedTime': meta.get('modifiedTime'),
+                'extension': extension,
+                'unzipped': unzip,
+                'status': future.result(),
+            }
+        save_manifest(args.destination_dir, manifest)
+        # Reports errors in the original order of the students.
+        for email, future in futures.items():
+            if future.result() != 'ok':
+                bad_files.setdefault(future.result(), []).append(email)
     # Finally, writes the csv file with all the students who have submitted,
     # so their work can be included.
     csv_fn = os.path.join(args.destination_dir, 'students.csv')
@@ -109,8 +463,8 @@ def main(args):
         writer.writeheader()
         for email in student_submissions.keys():
             writer.writerow({'email': email})
-    if bad_files:
-        print(f"Errors in unzipping files for {bad_files}")
+    for status, emails in bad_files.items():
+        print(f"{STATUS_MESSAGES.get(status, status)}: {emails}")
 
 
 if __name__ == '__main__':
@@ -118,9 +472,9 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--spreadsheet_id', default=None,
                         help="ID of the spreadsheet to use as base of download.")
     parser.add_argument('-m', '--email_column', default='B',
-                        help='Column containing email')
+                        help='Column containing email, as a letter or a header name')
     parser.add_argument('-f', '--file_column', default='C',
-                        help='Column containing submission')
+                        help='Column containing submission, as a letter or a header name')
     parser.add_argument('--sheet', type=str, default='Form Responses 1',
                         help='Sheet name')
     parser.add_argument('-e', '--extension', type=str, default='zip',
@@ -135,5 +489,39 @@ if __name__ == '__main__':
     parser.add_argument('--students', type=str, default=None,
                         help='Comma-separated list of student emails whose work we want to download. '
                         'If not specified, all students are downloaded.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of submissions to download concurrently.')
+    parser.add_argument('--timing', action='store_true', default=False,
+                        help='Print the time taken to load the credentials and services.')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='Read from the sheet only the responses added since the previous run.')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Download all submissions, even those that are unchanged '
+                        'since the previous download.')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='Unzip the submissions directly from the download, without '
+                        'writing the zip files to disk.')
+    parser.add_argument('--spool_mb', type=float, default=64,
+                        help='With --stream, downloads larger than this many MB are '
+                        'buffered on disk rather than in memory.')
+    parser.add_argument('--include', action='append', default=None, metavar='GLOB',
+                        help='Only extract the files matching this glob (can be repeated).')
+    parser.add_argument('--exclude', action='append', default=None, metavar='GLOB',
+                        help='Do not extract the files or directories matching this glob, '
+                        'e.g. node_modules, .git, __pycache__ (can be repeated).')
+    parser.add_argument('--max_unzipped_mb', type=float, default=None,
+                        help='Reject submissions whose uncompressed size exceeds this many MB.')
+    parser.add_argument('--store', type=str, default=None,
+                        help='Directory of a content-addressed store, shared across assignments, '
+                        'where identical extracted files are kept only once.')
+    parser.add_argument('--max_download_mb', type=float, default=None,
+                        help='Do not download submissions larger than this many MB.')
+    parser.add_argument('--export_format', type=str, default=None,
+                        choices=sorted(EXPORT_MIME_TYPES),
+                        help='Format to which submissions that are Google Docs, Sheets, etc. '
+                        'are exported (default: pdf, or xlsx for Sheets).')
+    api_metrics.add_arguments(parser)
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    api_metrics.start(args)
+    main(args)
+    api_metrics.finish(args)
\ No newline at end of file
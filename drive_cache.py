@@ -0,0 +1,115 @@
+"""Local cache of Drive metadata, used by ls.py.
+
+The cache stores, for each folder that has been listed, its children
+(id, parent, name, size, mimeType, modifiedTime).  It is kept up to date
+via the Drive changes feed, so that a listing needs to read from Drive
+only what changed since the previous run.
+"""
+
+import sqlite3
+
+
+class DriveCache(object):
+
+    def __init__(self, cache_file):
+        """Opens (creating it if needed) the cache in cache_file."""
+        self.db = sqlite3.connect(cache_file)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            id TEXT, parent TEXT, name TEXT, size INTEGER, mimeType TEXT,
+            modifiedTime TEXT, PRIMARY KEY (id, parent))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_parent ON files (parent)")
+        # Folders whose children are all in the cache.
+        self.db.execute("CREATE TABLE IF NOT EXISTS listed (folder_id TEXT PRIMARY KEY)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+        self.db.commit()
+
+    def clear(self):
+        """Empties the cache."""
+        for table in ['files', 'listed', 'meta']:
+            self.db.execute(f"DELETE FROM {table}")
+        self.db.commit()
+
+    def children(self, folder_id):
+        """Returns the list of children of a folder, in the format of
+        files().list, or None if the folder has not been listed."""
+        if self.db.execute("SELECT 1 FROM listed WHERE folder_id = ?",
+                           (folder_id,)).fetchone() is None:
+            return None
+        files = []
+        for file_id, name, size, mime, modified in self.db.execute(
+                "SELECT id, name, size, mimeType, modifiedTime FROM files "
+                "WHERE parent = ? ORDER BY rowid", (folder_id,)):
+            file = {'id': file_id, 'name': name, 'mimeType': mime,
+                    'modifiedTime': modified, 'parents': [folder_id]}
+            if size is not None:
+                file['size'] = size
+            files.append(file)
+        return files
+
+    def store_listing(self, children):
+        """Stores the listing of folders, given as a dictionary from folder
+        id to the list of its children."""
+        for folder_id, files in children.items():
+            self.db.execute("DELETE FROM files WHERE parent = ?", (folder_id,))
+            for file in files:
+                self._insert(file, folder_id)
+            self.db.execute("INSERT OR REPLACE INTO listed VALUES (?)", (folder_id,))
+        self.db.commit()
+
+    def apply_changes(self, drive_service):
+        """Applies the changes that occurred in Drive since the last call.
+        Raises HttpError if the changes can no longer be read, in which
+        case the cache should be cleared."""
+        page_token = self.get_meta('page_token')
+        if page_token is None:
+            self.start_changes(drive_service)
+            return 0
+        num_changes = 0
+        while page_token is not None:
+            response = drive_service.changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                pageSize=1000,
+                fields='nextPageToken, newStartPageToken, changes(fileId, removed, '
+                       'file(id, name, parents, size, mimeType, modifiedTime))',
+            ).execute()
+            for change in response.get('changes', []):
+                num_changes += 1
+                self.db.execute("DELETE FROM files WHERE id = ?", (change.get('fileId'),))
+                file = change.get('file')
+                if change.get('removed') or file is None:
+                    self.db.execute("DELETE FROM listed WHERE folder_id = ?",
+                                    (change.get('fileId'),))
+                    continue
+                for parent in file.get('parents', []):
+                    self._insert(file, parent)
+            if 'newStartPageToken' in response:
+                self.set_meta('page_token', response['newStartPageToken'])
+            page_token = response.get('nextPageToken')
+        self.db.commit()
+        return num_changes
+
+    def start_changes(self, drive_service):
+        """Records the current position of the changes feed; to be called
+        before listing anything into an empty cache."""
+        self.set_meta('page_token', drive_service.changes().getStartPageToken().execute().get(
+            'startPageToken'))
+
+    def _insert(self, file, parent):
+        size = file.get('size')
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                        (file['id'], parent, file.get('name'),
+                         None if size is None else int(size),
+                         file.get('mimeType'), file.get('modifiedTime')))
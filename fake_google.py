@@ -0,0 +1,613 @@
+"""Local, in-process fake of the Drive and Sheets APIs, for load testing.
+
+The fake serves a directory tree: the files and folders under <root>/drive
+are the Drive files, with their path relative to it as id (the top
+folder is 'root'), and each <root>/sheets/<spreadsheet_id>/<sheet>.csv is
+a sheet.  It implements the parts of the APIs used by the tools:
+files.list/get/get_media/export_media/create/update, permissions.create,
+changes.getStartPageToken/list, batch requests, and
+spreadsheets.values.get/batchGet.  Uploaded files are written to the
+tree, so they can be inspected.  Files named *.gdoc, *.gsheet, and
+*.gslides stand for Google Docs, Sheets, and Slides: they have no size
+or checksum, and are exported as they are, whatever the format asked.
+The changes are logged in <root>/changes.log, one file id per line, and a
+page token is a position in the log, so that the tokens saved by one
+process are valid in the next ones.
+
+Each request is delayed by the configured latency, and fails with a 429
+error with the given probability, or when more than max_qps requests are
+made in a second, so that concurrency and retries can be measured
+without touching the real APIs and their quotas.  The requests are
+recorded in api_metrics.metrics, as those to the real APIs are.
+
+The tools use the fake when the environment variable
+CLASS_TOOLS_FAKE_BACKEND is set to the root directory (see
+google_services.py); CLASS_TOOLS_FAKE_LATENCY, CLASS_TOOLS_FAKE_ERROR_RATE,
+and CLASS_TOOLS_FAKE_MAX_QPS configure it, and if
+CLASS_TOOLS_FAKE_STATS is set, the number of requests made is written
+there as JSON at exit.
+"""
+
+import atexit
+import csv
+import datetime
+import hashlib
+import http.client
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+
+from googleapiclient.errors import HttpError
+
+from api_metrics import metrics
+
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+NATIVE_MIMES = {
+    '.gdoc': 'application/vnd.google-apps.document',
+    '.gsheet': 'application/vnd.google-apps.spreadsheet',
+    '.gslides': 'application/vnd.google-apps.presentation',
+}
+DEFAULT_FIELDS = 'id, name, mimeType'
+_PARENT_QUERY = re.compile(r"'([^']*)' in parents")
+_NAME_QUERY = re.compile(r"name = '((?:[^'\\]|\\.)*)'")
+_CELLS = re.compile(r'^([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$')
+
+
+class FakeResponse(dict):
+    """HTTP response, with the interface of httplib2.Response."""
+
+    def __init__(self, status, headers=None):
+        super().__init__(headers or {})
+        self.status = status
+        self.reason = http.client.responses.get(status, '')
+
+
+def http_error(status, message):
+    content = json.dumps({'error': {'code': status, 'message': message}}).encode()
+    return HttpError(FakeResponse(status), content)
+
+
+def column_index(letters):
+    """Returns the 0-based index of a column given by letters."""
+    index = 0
+    for c in letters:
+        index = index * 26 + ord(c) - ord('A') + 1
+    return index - 1
+
+
+def select(meta, fields):
+    """Returns the fields of the metadata of a file."""
+    names = [f.strip() for f in (fields or DEFAULT_FIELDS).split(',')]
+    return {name: meta[name] for name in names if name in meta}
+
+
+def files_fields(fields):
+    """Returns the fields of the files in a response, given the fields
+    of the response, such as 'nextPageToken, files(id, name)'."""
+    m = re.search(r'files\(([^)]*)\)', fields or '')
+    return m.group(1) if m else None
+
+
+class FakeGoogle(object):
+
+    def __init__(self, root_dir, latency=0.0, error_rate=0.0, max_qps=None, seed=None):
+        """Serves the tree in root_dir.
+        @:param latency: mean delay, in seconds, of each request.
+        @:param error_rate: probability that a request fails with 429.
+        @:param max_qps: if given, requests beyond this number per second
+        fail with 429.
+        """
+        self.root_dir = root_dir
+        self.drive_dir = os.path.join(root_dir, 'drive')
+        self.sheets_dir = os.path.join(root_dir, 'sheets')
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_qps = max_qps
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.recent = deque() # Times of the requests in the last second.
+        self.files = {} # id -> metadata
+        self.paths = {} # id -> path of the content
+        self.permissions = {} # id -> list of permissions
+        self.changes_file = os.path.join(root_dir, 'changes.log')
+        self.sheets = {} # (spreadsheet id, sheet name) -> rows
+        os.makedirs(self.drive_dir, exist_ok=True)
+        self._scan()
+
+    @classmethod
+    def from_env(cls):
+        """Creates the fake configured by the CLASS_TOOLS_FAKE_* variables."""
+        fake = cls(os.environ['CLASS_TOOLS_FAKE_BACKEND'],
+                   latency=float(os.environ.get('CLASS_TOOLS_FAKE_LATENCY', 0)),
+                   error_rate=float(os.environ.get('CLASS_TOOLS_FAKE_ERROR_RATE', 0)),
+                   max_qps=float(os.environ['CLASS_TOOLS_FAKE_MAX_QPS'])
+                   if os.environ.get('CLASS_TOOLS_FAKE_MAX_QPS') else None)
+        stats_file = os.environ.get('CLASS_TOOLS_FAKE_STATS')
+        if stats_file:
+            atexit.register(fake.save_stats, stats_file)
+        return fake
+
+    def save_stats(self, stats_file):
+        with self.lock:
+            with open(stats_file, 'w') as f:
+                json.dump(dict(self.stats), f, indent=2, sort_keys=True)
+
+    def service(self, name, version):
+        """Returns the fake of a service, as googleapiclient build would."""
+        if name == 'drive':
+            return FakeDrive(self)
+        if name == 'sheets':
+            return FakeSheets(self)
+        raise ValueError(f"The fake does not implement the {name} API")
+
+    # Requests.
+
+    def call(self, method, func, delay=True, key=None):
+        """Performs the request method by calling func, after the latency,
+        and possibly failing with a 429 error.  key identifies the request
+        in the metrics, to recognize retries."""
+        t0 = time.time()
+        if delay and self.latency > 0:
+            time.sleep(self.latency * self.rand.uniform(0.5, 1.5))
+        try:
+            with self.lock:
+                self.stats[method] += 1
+                now = time.monotonic()
+                self.recent.append(now)
+                while self.recent[0] < now - 1:
+                    self.recent.popleft()
+                if (self.rand.random() < self.error_rate or
+                        (self.max_qps is not None and len(self.recent) > self.max_qps)):
+                    self.stats['429'] += 1
+                    raise http_error(429, 'Rate Limit Exceeded')
+            # The lock only protects the bookkeeping and the metadata,
+            # so that requests reading or writing content run concurrently.
+            result = func()
+        except HttpError as e:
+            metrics.record(method, time.time() - t0, e.resp.status, key=key)
+            raise
+        if isinstance(result, tuple): # Media, with its size.
+            received = len(result[0])
+        elif isinstance(result, bytes):
+            received = len(result)
+        else:
+            received = 0 if result is None else len(json.dumps(result))
+        metrics.record(method, time.time() - t0, 200, received=received, key=key)
+        return result
+
+    # Drive.
+
+    def _scan(self):
+        """Reads the files and folders of the Drive tree."""
+        self.files['root'] = {'id': 'root', 'name': 'My Drive', 'mimeType': FOLDER_MIME,
+                              'parents': []}
+        for root, dirs, files in os.walk(self.drive_dir):
+            rel = os.path.relpath(root, self.drive_dir)
+            parent = 'root' if rel == '.' else rel.replace(os.sep, '/')
+            for name in sorted(dirs) + sorted(files):
+                self._load(name if parent == 'root' else parent + '/' + name)
+
+    def _load(self, file_id):
+        """Reads the metadata of file_id from the tree, returning it, or
+        None if the file does not exist."""
+        path = os.path.join(self.drive_dir, *file_id.split('/'))
+        parent, _, name = file_id.rpartition('/')
+        if os.path.isdir(path):
+            self.files[file_id] = {'id': file_id, 'name': name, 'mimeType': FOLDER_MIME,
+                                   'parents': [parent or 'root'],
+                                   'modifiedTime': self._mtime(path)}
+        elif os.path.isfile(path):
+            self.paths[file_id] = path
+            mime = NATIVE_MIMES.get(os.path.splitext(name)[1], 'application/octet-stream')
+            self.files[file_id] = {'id': file_id, 'name': name, 'mimeType': mime,
+                                   'parents': [parent or 'root']}
+            with open(path, 'rb') as f:
+                self.files[file_id].update(self._content_meta(f.read(), mime))
+            self.files[file_id]['modifiedTime'] = self._mtime(path)
+        return self.files.get(file_id)
+
+    def _mtime(self, path):
+        t = datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc)
+        return t.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    @staticmethod
+    def _content_meta(content, mime):
+        """Returns the size and md5Checksum of content; Google-native files
+        have neither."""
+        if mime in NATIVE_MIMES.values():
+            return {}
+        return {'size': str(len(content)), 'md5Checksum': hashlib.md5(content).hexdigest()}
+
+    def _log_change(self, file_id):
+        """Appends file_id to the change log; to be called with the lock held."""
+        with open(self.changes_file, 'a') as f:
+            f.write(json.dumps(file_id) + "\n")
+
+    def _read_changes(self):
+        """Returns the ids of the changed files, in order, logged by any process."""
+        if not os.path.exists(self.changes_file):
+            return []
+        with open(self.changes_file, 'r') as f:
+            return [json.loads(line) for line in f if line.endswith("\n")]
+
+    def start_page_token(self):
+        with self.lock:
+            return {'startPageToken': str(len(self._read_changes()))}
+
+    def _get(self, file_id):
+        """Returns the metadata of file_id; to be called with the lock held."""
+        if file_id not in self.files:
+            raise http_error(404, f"File not found: {file_id}.")
+        return self.files[file_id]
+
+    def _write(self, file_id, path, media):
+        """Writes the content of media to path, the content of file_id.
+        The content is written without holding the lock, and replaces the
+        previous one atomically, so that concurrent readers see either."""
+        content = media.getbytes(0, media.size()) if media is not None else b''
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        modified_time = self._mtime(path)
+        with self.lock:
+            meta = self.files[file_id]
+            meta.update(self._content_meta(content, meta['mimeType']),
+                        modifiedTime=modified_time)
+            self._log_change(file_id)
+
+    def list_files(self, q, page_size, page_token, fields):
+        parents = set(_PARENT_QUERY.findall(q or ''))
+        m = _NAME_QUERY.search(q or '')
+        with self.lock:
+            files = [dict(meta) for file_id, meta in sorted(self.files.items())
+                     if file_id != 'root' and (not parents or parents & set(meta['parents']))
+                     and (m is None or meta['name'] == m.group(1).replace("\\'", "'"))]
+        start = int(page_token or 0)
+        page_size = page_size or 100
+        response = {'files': [select(meta, files_fields(fields) or DEFAULT_FIELDS)
+                              for meta in files[start:start + page_size]]}
+        if start + page_size < len(files):
+            response['nextPageToken'] = str(start + page_size)
+        return response
+
+    def create_file(self, body, media, fields):
+        parent = (body.get('parents') or ['root'])[0]
+        mime = body.get('mimeType') or (
+            media.mimetype() if media is not None else 'application/octet-stream')
+        with self.lock:
+            self._get(parent)
+            base_id = body['name'] if parent == 'root' else parent + '/' + body['name']
+            file_id, n = base_id, 1
+            # Drive allows several files with the same name in a folder.
+            while file_id in self.files:
+                n += 1
+                file_id = f"{base_id}~{n}"
+            meta = {'id': file_id, 'name': body['name'], 'mimeType': mime,
+                    'parents': [parent]}
+            self.files[file_id] = meta
+            path = os.path.join(self.drive_dir, *file_id.split('/'))
+            if mime == FOLDER_MIME:
+                os.makedirs(path, exist_ok=True)
+                meta['modifiedTime'] = self._mtime(path)
+                self._log_change(file_id)
+                return select(meta, fields)
+            self.paths[file_id] = path
+        self._write(file_id, path, media)
+        with self.lock:
+            return select(meta, fields)
+
+    def update_file(self, file_id, body, media, fields):
+        with self.lock:
+            meta = self._get(file_id)
+            if body and 'name' in body:
+                meta['name'] = body['name']
+            if media is None:
+                self._log_change(file_id)
+                return select(meta, fields)
+            path = self.paths[file_id]
+        self._write(file_id, path, media)
+        with self.lock:
+            return select(meta, fields)
+
+    def read_media(self, file_id, start=0, end=None):
+        """Returns the content of a file, from start to end (inclusive),
+        and its size."""
+        with self.lock:
+            meta = self._get(file_id)
+            if file_id not in self.paths or meta['mimeType'] in NATIVE_MIMES.values():
+                raise http_error(403, "Only files with binary content can be downloaded.")
+            path = self.paths[file_id]
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(start)
+            content = f.read() if end is None else f.read(end - start + 1)
+        return content, size
+
+    def export(self, file_id):
+        """Returns the content of a Google-native file, exported."""
+        with self.lock:
+            meta = self._get(file_id)
+            if meta['mimeType'] not in NATIVE_MIMES.values():
+                raise http_error(403, "Export only supports Docs Editors files.")
+            path = self.paths[file_id]
+        with open(path, 'rb') as f:
+            content = f.read()
+        return content, len(content)
+
+    def get_file(self, file_id, fields):
+        with self.lock:
+            return select(self._get(file_id), fields)
+
+    def create_permission(self, file_id, body):
+        with self.lock:
+            self._get(file_id)
+            permissions = self.permissions.setdefault(file_id, [])
+            permission = dict(body, id=f"p{len(permissions)}")
+            permissions.append(permission)
+            return {'id': permission['id']}
+
+    def list_changes(self, page_token, page_size):
+        start = int(page_token)
+        end = start + (page_size or 100)
+        changes = []
+        with self.lock:
+            logged = self._read_changes()
+            for file_id in logged[start:end]:
+                # Files changed by other processes are read from the tree.
+                meta = self._load(file_id) if file_id not in self.files else self.files[file_id]
+                if meta is None:
+                    changes.append({'fileId': file_id, 'removed': True})
+                else:
+                    changes.append({'fileId': file_id, 'removed': False, 'file': dict(meta)})
+            num_changes = len(logged)
+        response = {'changes': changes}
+        if end < num_changes:
+            response['nextPageToken'] = str(end)
+        else:
+            response['newStartPageToken'] = str(num_changes)
+        return response
+
+    # Sheets.
+
+    def _rows(self, spreadsheet_id, sheet):
+        key = (spreadsheet_id, sheet)
+        with self.lock:
+            rows = self.sheets.get(key)
+        if rows is None:
+            path = os.path.join(self.sheets_dir, spreadsheet_id, sheet + '.csv')
+            if not os.path.exists(path):
+                raise http_error(400, f"Unable to parse range: {sheet}")
+            with open(path, 'r', newline='') as f:
+                rows = [row for row in csv.reader(f)]
+            with self.lock:
+                rows = self.sheets.setdefault(key, rows)
+        return rows
+
+    def read_range(self, spreadsheet_id, a1_range, major_dimension='ROWS'):
+        """Returns the value range of a1_range, such as 'Sheet 1'!B2:B."""
+        sheet, _, cells = a1_range.rpartition('!')
+        if sheet.startswith("'"):
+            sheet = sheet[1:-1].replace("''", "'")
+        if not sheet:
+            sheets = sorted(os.listdir(os.path.join(self.sheets_dir, spreadsheet_id)))
+            sheet = sheets[0][:-len('.csv')]
+        rows = self._rows(spreadsheet_id, sheet)
+        m = _CELLS.match(cells)
+        if m is None:
+            raise http_error(400, f"Unable to parse range: {a1_range}")
+        col0, row0, col1, row1 = m.groups()
+        if ':' not in cells:
+            col1, row1 = col0, row0
+        first_row = int(row0) - 1 if row0 else 0
+        last_row = int(row1) if row1 else len(rows)
+        first_col = column_index(col0) if col0 else 0
+        last_col = column_index(col1) + 1 if col1 else None
+        values = [row[first_col:last_col] for row in rows[first_row:last_row]]
+        if major_dimension == 'COLUMNS':
+            width = max((len(row) for row in values), default=0)
+            values = [[row[i] if i < len(row) else '' for row in values] for i in range(width)]
+        # Like the API, omits trailing empty cells and rows.
+        values = [self._trim(v) for v in values]
+        while values and not values[-1]:
+            values.pop()
+        value_range = {'range': a1_range, 'majorDimension': major_dimension}
+        if values:
+            value_range['values'] = values
+        return value_range
+
+    @staticmethod
+    def _trim(values):
+        values = list(values)
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+
+class FakeRequest(object):
+    """Request, with the interface of googleapiclient.http.HttpRequest."""
+
+    def __init__(self, backend, method, func, media=None, uri=None):
+        self.backend = backend
+        self.method = method
+        self.func = func
+        self.resumable = media if media is not None and media.resumable() else None
+        self.resumable_uri = None
+        self.resumable_progress = 0
+        self.uri = uri
+        self.headers = {}
+        self.http = FakeHttp(backend)
+
+    def execute(self, http=None, num_retries=0):
+        return self.backend.call(self.method, self.func, key=(self.method, id(self)))
+
+    def next_chunk(self, http=None, num_retries=0):
+        # The fake uploads all the content at once.
+        return None, self.execute()
+
+
+class FakeHttp(object):
+    """Serves the media downloads, with the interface of httplib2.Http."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        if method == 'GET' and uri.startswith('fake://export/'):
+            # Exports are not ranged.
+            file_id = uri[len('fake://export/'):]
+            try:
+                content, size = self.backend.call(
+                    'drive.files.export', lambda: self.backend.export(file_id), key=(method, uri))
+            except HttpError as e:
+                return e.resp, e.content
+            return FakeResponse(200, {'content-length': str(size)}), content
+        if method != 'GET' or not uri.startswith('fake://media/'):
+            # In particular, resumable sessions are unknown, and restart.
+            return FakeResponse(404), b''
+        file_id = uri[len('fake://media/'):]
+        m = re.match(r'bytes=(\d+)-(\d*)', {k.lower(): v for k, v in (headers or {}).items()}
+                     .get('range', ''))
+        start = int(m.group(1)) if m else 0
+        end = int(m.group(2)) if m and m.group(2) else None
+        try:
+            content, size = self.backend.call(
+                'drive.files.get_media', lambda: self.backend.read_media(file_id, start, end),
+                key=(method, uri))
+        except HttpError as e:
+            return e.resp, e.content
+        if m is None:
+            return FakeResponse(200, {'content-length': str(size)}), content
+        return FakeResponse(206, {'content-range': 'bytes %d-%d/%d' % (
+            start, start + len(content) - 1, size)}), content
+
+
+class FakeBatch(object):
+    """Batch request, with the interface of BatchHttpRequest."""
+
+    def __init__(self, backend, callback=None):
+        self.backend = backend
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        request_id = str(len(self.requests)) if request_id is None else request_id
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self, http=None):
+        # The whole batch has the latency of a single request.
+        self.backend.call('batch', lambda: None)
+        for request_id, request, callback in self.requests:
+            response, exception = None, None
+            try:
+                response = self.backend.call(request.method, request.func, delay=False)
+            except HttpError as e:
+                exception = e
+            if callback is not None:
+                callback(request_id, response, exception)
+
+
+class _Resource(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _request(self, method, func, **kwargs):
+        return FakeRequest(self.backend, method, func, **kwargs)
+
+
+class _Files(_Resource):
+
+    def list(self, q=None, pageSize=None, pageToken=None, fields=None, **kwargs):
+        return self._request('drive.files.list', lambda: self.backend.list_files(
+            q, pageSize, pageToken, fields))
+
+    def get(self, fileId, fields=None, **kwargs):
+        return self._request('drive.files.get', lambda: self.backend.get_file(fileId, fields))
+
+    def get_media(self, fileId, **kwargs):
+        return self._request('drive.files.get_media',
+                             lambda: self.backend.read_media(fileId)[0],
+                             uri='fake://media/' + fileId)
+
+    def export_media(self, fileId, mimeType, **kwargs):
+        return self._request('drive.files.export',
+                             lambda: self.backend.export(fileId)[0],
+                             uri='fake://export/' + fileId)
+
+    def create(self, body=None, media_body=None, fields=None, **kwargs):
+        return self._request('drive.files.create', lambda: self.backend.create_file(
+            body or {}, media_body, fields), media=media_body)
+
+    def update(self, fileId, body=None, media_body=None, fields=None, **kwargs):
+        return self._request('drive.files.update', lambda: self.backend.update_file(
+            fileId, body, media_body, fields), media=media_body)
+
+
+class _Permissions(_Resource):
+
+    def create(self, fileId, body, fields=None, **kwargs):
+        return self._request('drive.permissions.create',
+                             lambda: self.backend.create_permission(fileId, body))
+
+
+class _Changes(_Resource):
+
+    def getStartPageToken(self, **kwargs):
+        return self._request('drive.changes.getStartPageToken',
+                             self.backend.start_page_token)
+
+    def list(self, pageToken, pageSize=None, **kwargs):
+        return self._request('drive.changes.list',
+                             lambda: self.backend.list_changes(pageToken, pageSize))
+
+
+class FakeDrive(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def files(self):
+        return _Files(self.backend)
+
+    def permissions(self):
+        return _Permissions(self.backend)
+
+    def changes(self):
+        return _Changes(self.backend)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.backend, callback)
+
+
+class _Values(_Resource):
+
+    def get(self, spreadsheetId, range, majorDimension='ROWS', **kwargs):
+        return self._request('sheets.spreadsheets.values.get', lambda: self.backend.read_range(
+            spreadsheetId, range, majorDimension))
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension='ROWS', **kwargs):
+        return self._request('sheets.spreadsheets.values.batchGet', lambda: {
+            'spreadsheetId': spreadsheetId,
+            'valueRanges': [self.backend.read_range(spreadsheetId, r, majorDimension)
+                            for r in ranges]})
+
+
+class _Spreadsheets(_Resource):
+
+    def values(self):
+        return _Values(self.backend)
+
+
+class FakeSheets(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def spreadsheets(self):
+        return _Spreadsheets(self.backend)
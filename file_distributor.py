@@ -1,27 +1,510 @@
 # Copyright Luca de Alfaro, 2019.
 # BSD License.
 
+import hashlib
 import io
+import json
 import os
-import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
 
+from google_services import BATCH_SIZE, backoff_sleep, build_service, get_credentials
+
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets',
           'https://www.googleapis.com/auth/drive']
+# Maximum number of times a rate-limited request is retried.
+MAX_RETRIES = 8
+# Size of the chunks of resumable uploads; it must be a multiple of 256 KB.
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# Files up to this size are sent in a single request, rather than opening
+# an upload session; Drive accepts such uploads up to 5 MB.
+SIMPLE_UPLOAD_MAX = 5 * 1024 * 1024
+# Drive expires resumable upload sessions after a week.
+SESSION_MAX_AGE = 6 * 24 * 3600
+
+
+def is_rate_limited(e):
+    """Returns True if the HttpError e signals that we are sending
+    requests too fast."""
+    if e.resp.status == 429:
+        return True
+    return e.resp.status == 403 and b'ratelimitexceeded' in (e.content or b'').lower()
+
+
+def is_transient(e):
+    """Returns True if the HttpError e is worth retrying."""
+    return is_rate_limited(e) or e.resp.status >= 500
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter, whose rate adapts to rate-limit errors:
+    it halves on each error, and slowly recovers after successes."""
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until a request can be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.05)
+
+class MemoryReader(io.RawIOBase):
+    """Read-only file over a bytes-like object, which, unlike io.BytesIO,
+    does not copy a memoryview: only the chunks read are copied."""
+
+    def __init__(self, content):
+        self.view = memoryview(content).cast('B')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def readinto(self, b):
+        data = self.view[self.pos:self.pos + len(b)]
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else self.pos + size
+        data = self.view[self.pos:end].tobytes()
+        self.pos += len(data)
+        return data
+
+
+class UploadSessions(object):
+    """Persists the URIs of resumable upload sessions, so that an upload
+    interrupted by the end of the process can continue in a later run."""
+
+    def __init__(self, session_file):
+        self.session_file = session_file
+        self.lock = threading.Lock()
+        self.sessions = {}
+        if os.path.exists(session_file):
+            with open(session_file, 'r') as f:
+                self.sessions = json.load(f)
+
+    def get(self, key):
+        """Returns the URI of the session for key, or None."""
+        with self.lock:
+            session = self.sessions.get(key)
+        if session is None or time.time() - session['time'] > SESSION_MAX_AGE:
+            return None
+        return session['uri']
+
+    def put(self, key, uri):
+        with self.lock:
+            self.sessions[key] = {'uri': uri, 'time': time.time()}
+            self._save()
+
+    def remove(self, key):
+        with self.lock:
+            if self.sessions.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp_fn = self.session_file + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(self.sessions, f)
+        os.replace(tmp_fn, self.session_file)
+
+
+class FolderIndex(object):
+    """Index of the files in a Drive folder, by name.
+    The index is built by listing the folder once, and is then kept up to
+    date via the Drive changes feed.  If a cache file is given, the index
+    is persisted there, so that later runs need only read the changes.
+    If given, execute(request) is used to execute the requests, for
+    instance to retry them.
+    The index also records with whom we have shared each file, so that a
+    file whose sharing failed is shared again even if its content is
+    already up to date."""
+
+    def __init__(self, drive_service, folder_id, cache_file=None, execute=None):
+        self.drive_service = drive_service
+        self.execute = execute or (lambda request: request.execute())
+        self.folder_id = folder_id
+        self.cache_file = cache_file
+        self.by_id = {} # file id -> {'name', 'md5Checksum', 'modifiedTime'}
+        self.by_name = {} # name -> set of file ids
+        self.shared = {} # file id -> set of emails with which it is shared
+        self.page_token = None # Start token for the changes feed.
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Loads the index from the cache file, bringing it up to date,
+        or builds it from scratch if there is no usable cache."""
+        if self.cache_file is not None and os.path.exists(self.cache_file):
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+            if data.get('folder_id') == self.folder_id:
+                self.page_token = data['page_token']
+                for file_id, entry in data['files'].items():
+                    self._add(file_id, entry)
+                self.shared = {file_id: set(emails)
+                               for file_id, emails in data.get('shared', {}).items()}
+                try:
+                    self.refresh()
+                    return
+                except HttpError as e:
+                    print("Could not read Drive changes (%s); listing the folder again." % e)
+                    self.by_id, self.by_name = {}, {}
+        self.rebuild()
+
+    def rebuild(self):
+        """Builds the index by listing the folder."""
+        self.by_id, self.by_name = {}, {}
+        # The token is read before listing, so no change is missed.
+        self.page_token = self.execute(
+            self.drive_service.changes().getStartPageToken()).get('startPageToken')
+        q = "'%s' in parents and trashed = false" % self.folder_id
+        page_token = None
+        while True:
+            response = self.execute(self.drive_service.files().list(
+                q=q,
+                spaces='drive',
+                pageSize=1000,
+                fields='nextPageToken, files(id, name, md5Checksum, modifiedTime)',
+                pageToken=page_token))
+            for file in response.get('files', []):
+                self._add(file['id'], file)
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break
+
+    def refresh(self):
+        """Applies the changes that occurred in Drive since the last refresh."""
+        page_token = self.page_token
+        while page_token is not None:
+            response = self.execute(self.drive_service.changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                pageSize=1000,
+                fields='nextPageToken, newStartPageToken, changes(fileId, removed, '
+                       'file(id, name, parents, trashed, md5Checksum, modifiedTime))',
+            ))
+            for change in response.get('changes', []):
+                self._remove(change.get('fileId'))
+                file = change.get('file')
+                if (not change.get('removed') and file is not None and not file.get('trashed')
+                        and self.folder_id in file.get('parents', [])):
+                    self._add(file['id'], file)
+                else:
+                    self.shared.pop(change.get('fileId'), None)
+            if 'newStartPageToken' in response:
+                self.page_token = response['newStartPageToken']
+            page_token = response.get('nextPageToken')
+
+    def save(self):
+        """Saves the index to the cache file, if any."""
+        if self.cache_file is None:
+            return
+        tmp_fn = self.cache_file + '.tmp'
+        with self.lock:
+            with open(tmp_fn, 'w') as f:
+                json.dump({'folder_id': self.folder_id, 'page_token': self.page_token,
+                           'files': self.by_id,
+                           'shared': {file_id: sorted(emails)
+                                      for file_id, emails in self.shared.items()
+                                      if file_id in self.by_id}}, f)
+            os.replace(tmp_fn, self.cache_file)
+
+    def lookup(self, name):
+        """Returns the list of (id, md5Checksum) of the files with the given name."""
+        with self.lock:
+            return [(file_id, self.by_id[file_id].get('md5Checksum'))
+                    for file_id in sorted(self.by_name.get(name, ()))]
+
+    def is_shared(self, file_id, email):
+        """Returns True if we know that file_id is shared with email."""
+        with self.lock:
+            return email in self.shared.get(file_id, ())
+
+    def record_shared(self, file_id, email):
+        with self.lock:
+            self.shared.setdefault(file_id, set()).add(email)
+
+    def record(self, file):
+        """Records a file that has been created or updated, given its
+        Drive metadata (id, name, md5Checksum, modifiedTime)."""
+        with self.lock:
+            self._remove(file['id'])
+            self._add(file['id'], file)
+
+    def _add(self, file_id, file):
+        entry = {k: file.get(k) for k in ('name', 'md5Checksum', 'modifiedTime')}
+        self.by_id[file_id] = entry
+        self.by_name.setdefault(entry['name'], set()).add(file_id)
+
+    def _remove(self, file_id):
+        entry = self.by_id.pop(file_id, None)
+        if entry is not None:
+            self.by_name[entry['name']].discard(file_id)
+
 
 class FileDistributor(object):
 
-    def __init__(self, drive_service, share_folder_id):
-        """Initializes a file distributor."""
+    def __init__(self, drive_service, share_folder_id, index_file=None,
+                 service_factory=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 simple_upload_max=SIMPLE_UPLOAD_MAX, session_file=None, qps=None):
+        """Initializes a file distributor.
+        @:param index_file: if given, file where the index of the share
+        folder is persisted across runs.
+        @:param service_factory: if given, function returning a new Drive
+        service; it is used to give each worker thread its own service in
+        distribute_concurrently, as services are not thread-safe.
+        @:param chunk_size: size of the chunks of resumable uploads, a
+        multiple of 256 KB.
+        @:param simple_upload_max: files up to this size are uploaded in
+        a single request, and larger ones in resumable sessions.
+        @:param session_file: if given, file where the resumable upload
+        sessions are persisted, so that uploads interrupted by the end of
+        the process continue where they stopped.
+        @:param qps: if given, maximum number of requests per second, over
+        all the threads using the distributor.
+        """
         self.drive_service = drive_service
         self.share_folder_id = share_folder_id
+        self.index_file = index_file
+        self.service_factory = service_factory
+        self.chunk_size = chunk_size
+        self.simple_upload_max = simple_upload_max
+        self.sessions = None if session_file is None else UploadSessions(session_file)
+        self._index = None
+        self._local = threading.local()
+        self._bucket = None if qps is None else TokenBucket(qps)
 
-    def _distribute_media(self, email, media, file_name, mode='reader', update=False):
+    def _service(self):
+        """Returns the Drive service to be used by the current thread."""
+        if self.service_factory is None:
+            return self.drive_service
+        if getattr(self._local, 'drive_service', None) is None:
+            self._local.drive_service = self.service_factory()
+        return self._local.drive_service
+
+    def _execute(self, request, session_key=None):
+        """Executes a request, retrying with backoff the requests that fail
+        transiently.  When a rate limiter is active, waits for it, and slows
+        it down when requests are rate limited.
+        Resumable uploads with a session_key are persisted in the sessions."""
+        if session_key is None or self.sessions is None:
+            run = request.execute
+        else:
+            run = lambda: self._execute_resumable(request, session_key)
+        bucket = self._bucket
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                response = run()
+                if bucket is not None:
+                    bucket.speed_up()
+                return response
+            except HttpError as e:
+                if not is_transient(e) or attempt >= MAX_RETRIES:
+                    raise
+                if bucket is not None and is_rate_limited(e):
+                    bucket.slow_down()
+                attempt += 1
+                backoff_sleep(attempt)
+
+    def _execute_resumable(self, request, session_key):
+        """Executes a resumable upload chunk by chunk, recording its session
+        URI, and continuing the session recorded by a previous run, if any."""
+        if request.resumable_uri is None:
+            uri = self.sessions.get(session_key)
+            if uri is not None:
+                # Asks Drive how much of the upload it has received.
+                size = request.resumable.size()
+                resp, content = request.http.request(
+                    uri, 'PUT', headers={'Content-Range': 'bytes */%d' % size,
+                                         'content-length': '0'})
+                if resp.status in (200, 201):
+                    self.sessions.remove(session_key)
+                    return json.loads(content)
+                if resp.status == 308:
+                    request.resumable_uri = uri
+                    request.resumable_progress = (
+                        int(resp['range'].split('-')[1]) + 1 if 'range' in resp else 0)
+                    print("Resuming upload at byte %d of %d" % (request.resumable_progress, size))
+                else:
+                    # The session has expired; the upload starts over.
+                    self.sessions.remove(session_key)
+        response = None
+        while response is None:
+            _, response = request.next_chunk()
+            if response is None and self.sessions.get(session_key) != request.resumable_uri:
+                self.sessions.put(session_key, request.resumable_uri)
+        self.sessions.remove(session_key)
+        return response
+
+    def _media(self, content, mime):
+        """Returns the media object to upload content, a bytes-like object,
+        without copying it."""
+        size = memoryview(content).nbytes
+        # BytesIO shares the buffer of bytes objects, but copies other objects.
+        fd = io.BytesIO(content) if isinstance(content, bytes) else MemoryReader(content)
+        return MediaIoBaseUpload(fd, mime, chunksize=self.chunk_size,
+                                 resumable=size > self.simple_upload_max)
+
+    @property
+    def index(self):
+        """The index of the share folder, loaded on first use."""
+        if self._index is None:
+            self._index = FolderIndex(self.drive_service, self.share_folder_id,
+                                      cache_file=self.index_file, execute=self._execute)
+            self._index.load()
+        return self._index
+
+    def _share_many(self, shares, mode):
+        """Shares files with users, using batch requests.
+        @:param shares: list of (key, email, file_id).
+        @:param mode: mode with which to share the files.
+        @:return: a dictionary from key to the exception that occurred
+        in sharing, for the shares that failed.  The shares that fail
+        transiently, alone or because their whole batch fails, are
+        batched again with backoff, and if they keep failing, their
+        error is reported.
+        """
+        errors = {}
+        todo = list(range(len(shares)))
+        attempt = 0
+        while todo:
+            retry = []
+            for i in range(0, len(todo), BATCH_SIZE):
+                # Keys need not be unique, so requests are identified by position.
+                chunk = todo[i:i + BATCH_SIZE]
+                chunk_errors = {}
+                def callback(request_id, response, exception):
+                    if exception is not None:
+                        chunk_errors[int(request_id)] = exception
+                batch = self.drive_service.new_batch_http_request(callback=callback)
+                for j in chunk:
+                    key, email, file_id = shares[j]
+                    user_permission = {
+                        'type': 'user',
+                        'role': mode,
+                        'emailAddress': email
+                    }
+                    batch.add(self.drive_service.permissions().create(
+                        fileId=file_id,
+                        body=user_permission,
+                        fields='id',
+                        sendNotificationEmail=False, # otherwise, Google throttles us
+                    ), request_id=str(j))
+                try:
+                    batch.execute()
+                except Exception as e:
+                    chunk_errors = {j: e for j in chunk}
+                for j in chunk:
+                    e = chunk_errors.get(j)
+                    if e is None:
+                        errors.pop(j, None)
+                        continue
+                    errors[j] = e
+                    if isinstance(e, HttpError) and is_transient(e):
+                        retry.append(j)
+            attempt += 1
+            if not retry or attempt > MAX_RETRIES:
+                break
+            backoff_sleep(attempt)
+            todo = retry
+        for j, (key, email, file_id) in enumerate(shares):
+            if j not in errors and self._index is not None:
+                self._index.record_shared(file_id, email)
+        return {shares[j][0]: e for j, e in errors.items()}
+
+    def _upload(self, media, file_name, update, md5=None):
+        """Uploads media to the share folder.
+        @:param update: if True, and files by the same name exist, they
+        are updated rather than a new file being created.
+        @:param md5: if given, md5 of the media; files that already have
+        this content are not uploaded again.
+        @:return: the ids of the files with that name, created, updated,
+        or already up to date.
+        """
+        fields = 'id, name, md5Checksum, modifiedTime'
+        if update:
+            existing_files = self.index.lookup(file_name)
+            if existing_files:
+                # We update all files we find, because we could have old copies.
+                for file_id, file_md5 in existing_files:
+                    if md5 is not None and file_md5 == md5:
+                        continue
+                    upfile = self._execute(self._service().files().update(
+                        fileId=file_id,
+                        media_body=media,
+                        fields=fields
+                    ), session_key=self._session_key(media, file_id, file_name, md5))
+                    self.index.record(upfile)
+                return [file_id for file_id, _ in existing_files]
+        # The new file is created.
+        file_meta = {'name': file_name, 'parents': [self.share_folder_id]}
+        upfile = self._execute(self._service().files().create(
+            body=file_meta,
+            media_body=media,
+            fields=fields), session_key=self._session_key(
+                media, self.share_folder_id, file_name, md5))
+        if self._index is not None:
+            self._index.record(upfile)
+        return [upfile.get('id')]
+
+    def _needs_sharing(self, file_id, email):
+        """Returns True unless the index knows that file_id is shared with email.
+        Sharing a file again with the same user is harmless."""
+        return self._index is None or not self._index.is_shared(file_id, email)
+
+    def _session_key(self, media, target, file_name, md5):
+        """Returns the key under which the session of a resumable upload of
+        media to target (a file id, or the share folder) is persisted."""
+        if self.sessions is None or md5 is None or not media.resumable():
+            return None
+        return json.dumps([target, file_name, md5])
+
+    def _distribute_media(self, email, media, file_name, mode='reader', update=False,
+                          md5=None):
         """Distributes media to the student.
         @:param email: email of the user.
         @:param media: Google media object for upload.
@@ -30,59 +513,29 @@ class FileDistributor(object):
         can be one of 'reader', 'writer', 'commenter'.
         @:param update: if True, check if a file by the same name exists,
         and if so, updates the feedback.
+        @:param md5: md5 of the media, used to skip uploading content
+        that is already in Drive.
         """
         assert mode in ['reader', 'writer', 'commenter']
-        # Uploads the file.
-        file_meta = {'name': file_name, 'parents': [self.share_folder_id]}
-        # do_create keeps track of whether we need to create the file.
-        do_create = not update
-        if update:
-            # Checks if a file by the same name exists.
-            existing_file_ids = []
-            q = "'%s' in parents" % self.share_folder_id
-            q += " and name = '%s'" % file_name
-            page_token = None
-            while True:
-                response = self.drive_service.files().list(
-                    q=q,
-                    spaces='drive',
-                    fields='nextPageToken, files(id, name)',
-                    pageToken=page_token).execute()
-                for file in response.get('files', []):
-                    existing_file_ids.append(file.get('id'))
-                page_token = response.get('nextPageToken', None)
-                if page_token is None:
-                    break
-            if len(existing_file_ids) == 0:
-                # We need to create.
-                do_create = True
-            else:
-                # We can perform the update.
-                # We update all files we find, because we could have old copies.
-                for file_id in existing_file_ids:
-                    self.drive_service.files().update(
-                        fileId=file_id,
-                        media_body=media
-                    ).execute()
-        if do_create:
-            # The new file is created.
-            upfile = self.drive_service.files().create(
-                body=file_meta,
-                media_body=media,
-                fields='id').execute()
-            file_id = upfile.get('id')
+        for file_id in self._upload(media, file_name, update, md5=md5):
+            if not self._needs_sharing(file_id, email):
+                continue
             # Shares the file
             user_permission = {
                 'type': 'user',
                 'role': mode,
                 'emailAddress': email
             }
-            self.drive_service.permissions().create(
+            self._execute(self._service().permissions().create(
                 fileId=file_id,
                 body=user_permission,
                 fields='id',
                 sendNotificationEmail=False, # otherwise, Google throttles us
-            ).execute()
+            ))
+            if self._index is not None:
+                self._index.record_shared(file_id, email)
+        if self._index is not None:
+            self._index.save()
 
 
     def distribute_file(self, email, file_path, file_name, mime,
@@ -98,8 +551,15 @@ class FileDistributor(object):
         and if so, updates the feedback.
         See https://developers.google.com/drive/api/v3/reference/permissions/create
         """
-        media = MediaFileUpload(file_path, mimetype=mime, resumable=True)
-        self._distribute_media(email, media, file_name, mode, update=update)
+        size = os.path.getsize(file_path)
+        media = MediaFileUpload(file_path, mimetype=mime, chunksize=self.chunk_size,
+                                resumable=size > self.simple_upload_max)
+        h = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        md5 = h.hexdigest()
+        self._distribute_media(email, media, file_name, mode, update=update, md5=md5)
         print("Distributed %s to %s" % (file_name, email))
 
 
@@ -107,7 +567,8 @@ class FileDistributor(object):
                          mime='text/html', mode='reader', update=True):
         """Distributes bytes to the user.
         @:param email: email of the user.
-        @:param text: the text to distribute
+        @:param content_bytes: the content to distribute, as bytes,
+        bytearray, or memoryview; it is not copied.
         @:param file_name: file name to use in drive.
         @:param mime: mime type of file to be distributed.
         Can also be 'text/html', etc.
@@ -116,41 +577,124 @@ class FileDistributor(object):
         @:param update: if True, check if a file by the same name exists,
         and if so, updates the feedback.
         """
-        buffer = io.BytesIO()
-        buffer.write(content_bytes)
-        media = MediaIoBaseUpload(buffer, mime, resumable=True)
-        self._distribute_media(email, media, file_name, mode, update=update)
-        buffer.close()
+        media = self._media(content_bytes, mime)
+        self._distribute_media(email, media, file_name, mode, update=update,
+                               md5=hashlib.md5(content_bytes).hexdigest())
         print("Distributed %s to %s" % (file_name, email))
 
 
+    def distribute_many(self, items, mime='text/html', mode='reader', update=True):
+        """Distributes several files, each to its user.
+        The share folder is indexed only once, and the files are shared
+        using batch requests; only the uploads are done one by one.
+        @:param items: list of (email, content_bytes, file_name).
+        @:param mime: mime type of the files to be distributed.
+        @:param mode: mode with which to distribute the files.  It
+        can be one of 'reader', 'writer', 'commenter'.
+        @:param update: if True, files having the same name as existing
+        files are updated rather than created.
+        @:return: a list with, for each item, None if the item was
+        distributed successfully, and the exception that occurred otherwise.
+        """
+        assert mode in ['reader', 'writer', 'commenter']
+        results = [None] * len(items)
+        shares = []
+        for i, (email, content_bytes, file_name) in enumerate(items):
+            try:
+                media = self._media(content_bytes, mime)
+                file_ids = self._upload(media, file_name, update,
+                                        md5=hashlib.md5(content_bytes).hexdigest())
+                shares.extend((i, email, file_id) for file_id in file_ids
+                              if self._needs_sharing(file_id, email))
+            except Exception as e:
+                results[i] = e
+        for i, e in self._share_many(shares, mode).items():
+            results[i] = e
+        if self._index is not None:
+            self._index.save()
+        for (email, _, file_name), error in zip(items, results):
+            if error is None:
+                print("Distributed %s to %s" % (file_name, email))
+            else:
+                print("Error distributing %s to %s: %s" % (file_name, email, error))
+        return results
+
+
+    def distribute_concurrently(self, items, mime='text/html', mode='reader', update=True,
+                                workers=4, qps=5.0, journal_file=None):
+        """Distributes several files, each to its user, using concurrent
+        workers whose requests are rate limited, slowing down when Drive
+        signals that we are too fast.
+        @:param items: list of (email, content_bytes, file_name).
+        @:param mime: mime type of the files to be distributed.
+        @:param mode: mode with which to distribute the files.  It
+        can be one of 'reader', 'writer', 'commenter'.
+        @:param update: if True, files having the same name as existing
+        files are updated rather than created.
+        @:param workers: number of concurrent workers.  Unless a
+        service_factory was given, there is a single worker.
+        @:param qps: maximum number of requests per second.
+        @:param journal_file: if given, file where the distributed items
+        are recorded, by share folder, email, file name, and md5 of the
+        content; items recorded there by a previous, interrupted run are
+        skipped, unless their folder or content differ.
+        @:return: a list with, for each item, None if the item was
+        distributed successfully (now or in a previous run), and the
+        exception that occurred otherwise.
+        """
+        assert mode in ['reader', 'writer', 'commenter']
+        def journal_key(item):
+            email, content_bytes, file_name = item
+            return (self.share_folder_id, email, file_name,
+                    hashlib.md5(content_bytes).hexdigest())
+        done = set()
+        if journal_file is not None and os.path.exists(journal_file):
+            with open(journal_file, 'r') as f:
+                done = {tuple(json.loads(line)) for line in f if line.strip()}
+        if self.service_factory is None:
+            workers = 1
+        journal = None if journal_file is None else open(journal_file, 'a')
+        journal_lock = threading.Lock()
+        bucket, self._bucket = self._bucket, TokenBucket(qps)
+
+        def distribute(item):
+            email, content_bytes, file_name = item
+            key = journal_key(item)
+            if key in done:
+                return None
+            try:
+                self.distribute_bytes(email, content_bytes, file_name,
+                                      mime=mime, mode=mode, update=update)
+            except Exception as e:
+                print("Error distributing %s to %s: %s" % (file_name, email, e))
+                return e
+            if journal is not None:
+                with journal_lock:
+                    journal.write(json.dumps(list(key)) + "\n")
+                    journal.flush()
+            return None
+
+        try:
+            if update:
+                # Loads the index, rate limited, before the workers need it.
+                self.index
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                results = list(pool.map(distribute, items))
+        finally:
+            self._bucket = bucket
+            if journal is not None:
+                journal.close()
+        skipped = sum(1 for item in items if journal_key(item) in done)
+        if skipped:
+            print("Skipped %d files already distributed in a previous run" % skipped)
+        return results
+
+
 # The following is for testing.
 if __name__ == '__main__':
-    creds = None
-    # The file token.pickle stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-            except:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    'credentials.json', SCOPES)
-                creds = flow.run_local_server()
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server()
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-
-    drive_service = build('drive', 'v3', credentials=creds)
+    creds = get_credentials(SCOPES)
+
+    drive_service = build_service('drive', 'v3', creds)
 
     fd = FileDistributor(drive_service, 'my_class', 'some_id')
     fd.distribute_bytes('luca@ucsc.edu',
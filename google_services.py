@@ -0,0 +1,196 @@
+"""Credentials and services for the Google APIs, shared by all the tools.
+
+The credentials are loaded once per process, and refreshed ahead of
+their expiry.  Services are built from the discovery documents bundled
+with googleapiclient, without fetching them over the network (older
+versions, which have none, cache them on disk), and each thread can get
+its own service objects, as they are not thread-safe.
+
+If the environment variable CLASS_TOOLS_FAKE_BACKEND is set, the services
+are instead served by a local fake (see fake_google.py), which is useful
+to measure the tools without touching Google's quotas.
+"""
+
+import datetime
+import hashlib
+import os
+import pickle
+import random
+import threading
+import time
+
+from googleapiclient.discovery import build
+from googleapiclient.discovery_cache.base import Cache
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.transport.requests import Request
+
+from api_metrics import TracedRequest
+
+# Credentials are refreshed when they expire within this time.
+REFRESH_MARGIN = datetime.timedelta(minutes=10)
+DISCOVERY_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'class_tools', 'discovery')
+
+# If set, directory served by the fake backend.
+FAKE_BACKEND_ENV = 'CLASS_TOOLS_FAKE_BACKEND'
+# Maximum number of requests that Drive accepts in a single batch.
+BATCH_SIZE = 100
+
+# Cold-start timings, as a list of (what, seconds).
+timings = []
+_backend = None
+_creds = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class DiscoveryCache(Cache):
+    """Caches discovery documents on disk, for the versions of
+    googleapiclient that do not bundle them."""
+
+    def __init__(self, cache_dir=DISCOVERY_CACHE_DIR, max_age=7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, url, content):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self._path(url) + '.%d.tmp' % os.getpid()
+            with open(tmp_path, 'w') as f:
+                f.write(content)
+            os.replace(tmp_path, self._path(url))
+        except OSError:
+            pass # The cache is only an optimization.
+
+
+_discovery_cache = DiscoveryCache()
+
+
+def use_backend(backend):
+    """Makes build_service return the services of backend, such as a
+    fake_google.FakeGoogle, rather than those of the Google APIs.
+    Passing None goes back to the Google APIs."""
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    """Returns the backend in use, or None for the Google APIs."""
+    global _backend
+    with _lock:
+        if _backend is None and os.environ.get(FAKE_BACKEND_ENV):
+            from fake_google import FakeGoogle
+            _backend = FakeGoogle.from_env()
+    return _backend
+
+
+def backoff_sleep(attempt):
+    """Sleeps with jittered exponential backoff before retry number attempt."""
+    time.sleep(random.uniform(0, min(64, 2 ** attempt)))
+
+
+def _timed(what, t0):
+    with _lock:
+        timings.append((what, time.time() - t0))
+
+
+def _expires_soon(creds):
+    expiry = getattr(creds, 'expiry', None)
+    if expiry is None:
+        return False
+    # google-auth uses naive UTC datetimes.
+    return expiry - datetime.datetime.utcnow() < REFRESH_MARGIN
+
+
+def get_credentials(scopes, token_file='token.pickle', credentials_file='credentials.json'):
+    """Returns the credentials for the given scopes, loading them once per
+    process, and refreshing them if they are about to expire.
+    With a backend other than the Google APIs, there are no credentials."""
+    if get_backend() is not None:
+        return None
+    key = (tuple(scopes), token_file)
+    with _lock:
+        creds = _creds.get(key)
+        if creds is not None and creds.valid and not _expires_soon(creds):
+            return creds
+        t0 = time.time()
+        # The file token.pickle stores the user's access and refresh tokens, and is
+        # created automatically when the authorization flow completes for the first
+        # time.
+        if creds is None and os.path.exists(token_file):
+            with open(token_file, 'rb') as token:
+                creds = pickle.load(token)
+        # If there are no (valid) credentials available, let the user log in.
+        if not creds or not creds.valid or _expires_soon(creds):
+            if creds and creds.refresh_token:
+                try:
+                    creds.refresh(Request())
+                except:
+                    flow = InstalledAppFlow.from_client_secrets_file(
+                        credentials_file, scopes)
+                    creds = flow.run_local_server()
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    credentials_file, scopes)
+                creds = flow.run_local_server()
+            # Save the credentials for the next run
+            with open(token_file, 'wb') as token:
+                pickle.dump(creds, token)
+        _creds[key] = creds
+    _timed('credentials', t0)
+    return creds
+
+
+def build_service(name, version, creds):
+    """Builds a service, without fetching the discovery document over
+    the network if possible.  The requests of the service are recorded
+    in api_metrics.metrics."""
+    t0 = time.time()
+    backend = get_backend()
+    if backend is not None:
+        service = backend.service(name, version)
+        _timed(f'build {name} {version}', t0)
+        return service
+    try:
+        service = build(name, version, credentials=creds, cache=_discovery_cache,
+                        requestBuilder=TracedRequest, static_discovery=True)
+    except TypeError:
+        # Older versions of googleapiclient have no bundled documents.
+        service = build(name, version, credentials=creds, cache=_discovery_cache,
+                        requestBuilder=TracedRequest)
+    _timed(f'build {name} {version}', t0)
+    return service
+
+
+def thread_service(name, version, creds):
+    """Returns a service for the current thread, building it on first use."""
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = {}
+    key = (name, version, id(creds))
+    if key not in services:
+        services[key] = build_service(name, version, creds)
+    return services[key]
+
+
+def print_timing():
+    """Prints the time spent loading credentials and building services."""
+    total = 0
+    for what, seconds in timings:
+        print(f"{what:20s} {seconds * 1000:8.1f} ms")
+        total += seconds
+    print(f"{'total':20s} {total * 1000:8.1f} ms")
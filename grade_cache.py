@@ -0,0 +1,106 @@
+"""Persistent cache of grading results.
+
+A result is reused when neither the student submission nor the grader
+have changed.  The submission is identified by a hash of its directory
+tree; to keep this fast, the digest of each file is remembered along
+with its mtime and size, and the file is only read again if these change.
+Files linked from a BlobStore are not read at all, as the store already
+knows their digest.
+"""
+
+import hashlib
+import os
+import sqlite3
+import stat
+
+# Name of the cache file, in the assignment directory.
+CACHE_NAME = '.grade_cache.sqlite'
+# Directories and file extensions produced by running the code, which
+# are not part of the submission.
+IGNORED_DIRS = {'__pycache__', '.pytest_cache', '.git'}
+IGNORED_EXTENSIONS = ('.pyc', '.pyo')
+
+
+def hash_file(path):
+    """Returns the hex sha256 digest of the content of a file."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class GradeCache(object):
+
+    def __init__(self, assignment_dir, store=None):
+        """Opens (creating it if needed) the grade cache of an assignment,
+        using the digests known to the BlobStore store, if given."""
+        self.assignment_dir = assignment_dir
+        self.store = store
+        self.db = sqlite3.connect(os.path.join(assignment_dir, CACHE_NAME))
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, digest TEXT)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS grades (
+            student TEXT PRIMARY KEY, tree_hash TEXT, grader_hash TEXT,
+            grade TEXT, reason TEXT, output TEXT)""")
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def _file_digest(self, path, st):
+        """Returns the digest of a file, reading it only if its mtime or
+        size differ from the ones recorded."""
+        if self.store is not None:
+            digest = self.store.digest_of(st)
+            if digest is not None:
+                return digest
+        rel = os.path.relpath(path, self.assignment_dir)
+        row = self.db.execute(
+            "SELECT mtime_ns, size, digest FROM files WHERE path = ?", (rel,)).fetchone()
+        if row is not None and row[0] == st.st_mtime_ns and row[1] == st.st_size:
+            return row[2]
+        digest = hash_file(path)
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                        (rel, st.st_mtime_ns, st.st_size, digest))
+        return digest
+
+    def tree_hash(self, student_dir):
+        """Returns a hash of the content of the directory tree of a student."""
+        h = hashlib.sha256()
+        root_dir = os.path.join(self.assignment_dir, student_dir)
+        for root, dirs, files in os.walk(root_dir):
+            dirs[:] = sorted(d for d in dirs if d not in IGNORED_DIRS)
+            for name in sorted(files):
+                if name.endswith(IGNORED_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                rel = os.path.relpath(path, root_dir)
+                h.update(rel.encode('utf-8', 'surrogateescape') + b'\0')
+                h.update(self._file_digest(path, st).encode() + b'\0')
+        self.db.commit()
+        return h.hexdigest()
+
+    def get(self, student, tree_hash, grader_hash):
+        """Returns the cached (grade, reason, output) of a student, or None
+        if there is no result for this submission and grader."""
+        row = self.db.execute(
+            "SELECT grade, reason, output FROM grades "
+            "WHERE student = ? AND tree_hash = ? AND grader_hash = ?",
+            (student, tree_hash, grader_hash)).fetchone()
+        return None if row is None else tuple(row)
+
+    def put(self, student, tree_hash, grader_hash, grade, reason, output):
+        """Stores the grading result of a student."""
+        self.db.execute("INSERT OR REPLACE INTO grades VALUES (?, ?, ?, ?, ?, ?)",
+                        (student, tree_hash, grader_hash, str(grade), reason, output))
+        self.db.commit()
+
+    def invalidate(self, student):
+        """Removes the cached result of a student."""
+        self.db.execute("DELETE FROM grades WHERE student = ?", (student,))
+        self.db.commit()
@@ -0,0 +1,95 @@
+"""Durable store of the grades of an assignment.
+
+Each result is committed as soon as the student is graded, so that an
+interrupted run loses nothing, and grades.csv is produced by merging all
+the stored results, so that regrading some of the students keeps the
+grades of the others.  Each run is recorded, so that a run that was
+interrupted can be resumed, grading only the students it had not reached.
+"""
+
+import csv
+import os
+import sqlite3
+import threading
+import time
+
+# Name of the store, in the assignment directory.
+STORE_NAME = '.grades.sqlite'
+
+
+class GradeStore(object):
+
+    def __init__(self, assignment_dir):
+        """Opens (creating it if needed) the grade store of an assignment."""
+        self.assignment_dir = assignment_dir
+        self.lock = threading.Lock()
+        # Results are stored by the grading threads as they finish.
+        self.db = sqlite3.connect(os.path.join(assignment_dir, STORE_NAME),
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, started REAL, finished REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS grades (
+            student TEXT PRIMARY KEY, grade TEXT, reason TEXT, output TEXT,
+            run INTEGER, graded REAL)""")
+        self.db.commit()
+        self.run_id = None
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    def start_run(self, resume=False):
+        """Starts a run.  If resume, and the previous run was interrupted,
+        continues it instead, returning the set of students it has graded."""
+        with self.lock:
+            if resume:
+                row = self.db.execute(
+                    "SELECT id, finished FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+                if row is not None and row[1] is None:
+                    self.run_id = row[0]
+                    return {student for student, in self.db.execute(
+                        "SELECT student FROM grades WHERE run = ?", (self.run_id,))}
+            self.run_id = self.db.execute("INSERT INTO runs (started) VALUES (?)",
+                                          (time.time(),)).lastrowid
+            self.db.commit()
+            return set()
+
+    def finish_run(self):
+        with self.lock:
+            self.db.execute("UPDATE runs SET finished = ? WHERE id = ?",
+                            (time.time(), self.run_id))
+            self.db.commit()
+
+    def put(self, student, grade, reason, output):
+        """Stores, and commits, the result of a student."""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO grades VALUES (?, ?, ?, ?, ?, ?)",
+                            (student, str(grade), reason, output, self.run_id, time.time()))
+            self.db.commit()
+
+    def get_all(self):
+        """Returns a dictionary from student to (grade, reason, output)."""
+        with self.lock:
+            return {student: (grade, reason, output) for student, grade, reason, output
+                    in self.db.execute("SELECT student, grade, reason, output FROM grades")}
+
+    def write_csv(self, csv_fn, students):
+        """Writes the stored grades of the given students, in order, to
+        csv_fn, atomically.  Students without a stored grade are omitted.
+        Returns the number of students written."""
+        results = self.get_all()
+        n = 0
+        tmp_fn = csv_fn + '.tmp'
+        with open(tmp_fn, 'w', newline='') as csvfile:
+            fieldnames=['student', 'grade', 'reason']
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter='\t')
+            writer.writeheader()
+            for student in students:
+                if student in results:
+                    grade, reason, _ = results[student]
+                    writer.writerow({'student': student, 'grade': grade, 'reason': reason})
+                    n += 1
+        os.replace(tmp_fn, csv_fn)
+        return n
@@ -1,34 +1,463 @@
 import argparse
+import contextlib
+import cProfile
 import csv
+import io
+import multiprocessing
 import os
+import signal
 import sys
+import tempfile
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-def main(args):
-    # Load the grade.py file
-    grade_path, grade_file = os.path.split(args.grade_file)
-    sys.path.append(grade_path)
-    grader = __import__(grade_file)
-    csv_fn = os.path.join(args.assignment_dir, 'grades.csv')
+from blob_store import BlobStore
+from grade_cache import GradeCache, hash_file
+from grade_store import GradeStore
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; memory limits are then not enforced.
+    resource = None
+
+# The grader module, loaded once per process.
+grader = None
+
+
+def load_grader(grade_file):
+    """Loads the grade.py file (given without the .py), once per process."""
+    global grader
+    if grader is None:
+        grade_path, grade_module = os.path.split(grade_file)
+        sys.path.append(grade_path)
+        grader = __import__(grade_module)
+    return grader
+
+
+def list_students(assignment_dir):
+    """Returns the sorted list of student directories in assignment_dir."""
+    with os.scandir(assignment_dir) as it:
+        return sorted(entry.name for entry in it if entry.is_dir() and "@" in entry.name)
+
+
+def _run_grader(student_path):
+    """Runs the grader on a submission, returning (grade, reason), where
+    reason is empty unless the grading failed."""
+    try:
+        test = grader.Assignment(student_path)
+        return test.grade(), ""
+    except MemoryError:
+        return 0, "memory limit exceeded"
+    except Exception as e:
+        traceback.print_exc()
+        return 0, f"error: {e!r}"
+
+
+def grade_student(student_path):
+    """Grades a submission in the current process.
+    Returns a triple (grade, reason, output), where output is what the
+    grader printed."""
+    buffer = io.StringIO()
+    with contextlib.redirect_stdout(buffer), contextlib.redirect_stderr(buffer):
+        grade, reason = _run_grader(student_path)
+    return grade, reason, buffer.getvalue()
+
+
+def grade_student_capturing_fds(student_path):
+    """Like grade_student, but also captures what is written directly to
+    the stdout and stderr file descriptors, for instance by programs
+    that the grader runs.  To be used only in grading subprocesses."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    with tempfile.TemporaryFile() as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+        try:
+            grade, reason, output = grade_student(student_path)
+        finally:
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+        f.seek(0)
+        output += f.read().decode('utf-8', 'replace')
+    return grade, reason, output
+
+
+def _peak_rss_mb():
+    """Returns the peak resident set size of this process, in MB."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in KB elsewhere.
+    return maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def _reset_peak_rss():
+    """Resets the peak resident set size of this process, so that it can
+    be read again with _peak_rss_since_reset_mb.  This is possible only on
+    Linux; returns True if it was done."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_since_reset_mb():
+    """Returns the peak resident set size of this process since the last
+    _reset_peak_rss, in MB."""
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def _children_cpu():
+    """Returns the CPU time used by the terminated children of this process."""
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(func, *args, cprofile_fn=None, shared=False):
+    """Calls func(*args), returning its result and a dictionary with the
+    wall time, CPU time (including subprocesses), and peak RSS.
+    The peak RSS is that of the whole process, unless shared is True, for
+    processes that grade several submissions: it is then the peak during
+    the call, or None where it cannot be measured (outside of Linux).
+    If cprofile_fn is given, the call is profiled, and the stats dumped there."""
+    profiler = cProfile.Profile() if cprofile_fn is not None else None
+    peak_reset = shared and _reset_peak_rss()
+    wall0, cpu0, children0 = time.time(), time.process_time(), _children_cpu()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        result = func(*args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_fn)
+    timing = {
+        'wall_s': time.time() - wall0,
+        'cpu_s': time.process_time() - cpu0 + _children_cpu() - children0,
+        'peak_rss_mb': (_peak_rss_mb() if not shared else
+                        _peak_rss_since_reset_mb() if peak_reset else None),
+    }
+    return result, timing
+
+
+def _grade_in_child(grade_file, student_path, memory_limit, conn, cprofile_fn=None):
+    """Entry point of the grading subprocess."""
+    _new_process_group()
+    _set_memory_limit(memory_limit)
+    load_grader(grade_file)
+    conn.send(measure(grade_student_capturing_fds, student_path, cprofile_fn=cprofile_fn))
+    conn.close()
+
+
+def _new_process_group():
+    """Makes the grading process the leader of a new process group, so that
+    it can be killed together with the processes the grader starts."""
+    if hasattr(os, 'setsid'):
+        os.setsid()
+
+
+def _kill_group(p):
+    """Kills the grading process p, and the processes it started that are
+    still running (servers, browsers, ...), even if p itself has exited."""
+    if hasattr(os, 'killpg') and p.pid is not None:
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass # The group is gone, or p had not yet created it.
+    if p.is_alive():
+        p.kill()
+
+
+def _set_memory_limit(memory_limit):
+    if memory_limit is not None and resource is not None:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _failure(p, timed_out, timeout, wall0):
+    """Returns the result and timing of a grading process p that has
+    failed to return a result."""
+    # We only know the wall time of failed gradings.
+    timing = {'wall_s': time.time() - wall0, 'cpu_s': None, 'peak_rss_mb': None}
+    if timed_out:
+        return (0, f"timeout after {timeout}s", ""), timing
+    if p.exitcode < 0:
+        return (0, f"crashed (signal {-p.exitcode})", ""), timing
+    return (0, f"crashed (exit code {p.exitcode})", ""), timing
+
+
+def _mp_context():
+    """Returns the multiprocessing context of the grading processes.
+    They are started from several threads, and a child forked while
+    another thread holds a lock (such as that of sys.stdout) can hang,
+    so they are forked from a single-threaded fork server instead."""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def grade_in_subprocess(args, student_path, cprofile_fn=None):
+    """Grades a submission in its own subprocess, enforcing the timeout
+    and memory limit in args.  Returns a triple (grade, reason, output),
+    and a dictionary with the timing of the grading (see measure)."""
+    ctx = _mp_context()
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_grade_in_child,
+                    args=(args.grade_file, student_path, args.memory_limit, child_conn,
+                          cprofile_fn))
+    wall0 = time.time()
+    p.start()
+    child_conn.close()
+    # Waits for the result rather than for the process, so that large
+    # results do not deadlock on the pipe.
+    timed_out = not parent_conn.poll(args.timeout)
+    result = None
+    if not timed_out:
+        try:
+            result = parent_conn.recv()
+        except EOFError:
+            pass # The child died without sending a result.
+        p.join(5)
+    _kill_group(p)
+    p.join()
+    parent_conn.close()
+    if result is not None:
+        return result
+    return _failure(p, timed_out, args.timeout, wall0)
+
+
+def _worker_loop(grade_file, memory_limit, conn):
+    """Entry point of a warm grading worker: imports the grader once, and
+    then grades the submissions it receives until told to stop."""
+    _new_process_group()
+    _set_memory_limit(memory_limit)
+    load_grader(grade_file)
+    conn.send(_peak_rss_mb())
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        student_path, cprofile_fn = request
+        conn.send(measure(grade_student_capturing_fds, student_path, cprofile_fn=cprofile_fn,
+                          shared=True))
+    conn.close()
+
+
+class GradingWorker(object):
+    """A subprocess that grades submissions one at a time, importing the
+    grader only once.  Submissions graded by the same worker are not
+    isolated from each other, so workers should be recycled regularly."""
+
+    def __init__(self, grade_file, memory_limit=None):
+        ctx = _mp_context()
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_loop,
+                                   args=(grade_file, memory_limit, child_conn), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.num_graded = 0
+        self.base_rss_mb = None
+
+    def grade(self, student_path, timeout, cprofile_fn=None):
+        """Grades a submission, returning (grade, reason, output) and its
+        timing.  If the grading times out or crashes, the worker is
+        killed, and must be replaced."""
+        wall0 = time.time()
+        try:
+            if self.base_rss_mb is None:
+                # Waits for the worker to have imported the grader.
+                self.base_rss_mb = self.conn.recv()
+            self.conn.send((student_path, cprofile_fn))
+            timed_out = not self.conn.poll(timeout)
+            if not timed_out:
+                self.num_graded += 1
+                return self.conn.recv()
+        except (EOFError, OSError):
+            timed_out = False # The worker died.
+        self.kill()
+        return _failure(self.process, timed_out, timeout, wall0)
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def close(self):
+        """Asks the worker to stop, killing it if it does not."""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        self.kill()
+
+    def kill(self):
+        """Kills the worker, and the processes started by the grader."""
+        _kill_group(self.process)
+        self.process.join()
+        self.conn.close()
+
+
+def grade_students(args, students, verbose=True, on_result=None):
+    """Grades the given student directories, in parallel if args.workers > 0.
+    If given, on_result(student, (grade, reason, output)) is called as
+    soon as each student is graded, possibly from several threads.
+    Returns two dictionaries, from student to (grade, reason, output),
+    and from student to timing (see measure)."""
+    cprofile_dir = getattr(args, 'cprofile_dir', None)
+    if cprofile_dir is not None:
+        os.makedirs(cprofile_dir, exist_ok=True)
+    use_pool = args.workers > 0 and getattr(args, 'pool', False)
+    # With a pool, each grading thread drives its own warm worker.
+    local = threading.local()
+    all_workers = []
+    lock = threading.Lock()
+
+    def grade_in_pool(student_path, cprofile_fn):
+        worker = getattr(local, 'worker', None)
+        if worker is None or not worker.is_alive():
+            worker = local.worker = GradingWorker(args.grade_file, args.memory_limit)
+            with lock:
+                all_workers.append(worker)
+        result, timing = worker.grade(student_path, args.timeout, cprofile_fn=cprofile_fn)
+        # Recycles the worker after too many submissions, or if its memory grew too much.
+        grown = (timing['peak_rss_mb'] or 0) - (worker.base_rss_mb or 0)
+        if (worker.is_alive() and (worker.num_graded >= args.recycle_after or
+                (args.recycle_mb is not None and grown > args.recycle_mb))):
+            worker.close()
+        return result, timing
+
+    def grade_one(student_dir):
+        student_path = os.path.join(args.assignment_dir, student_dir)
+        cprofile_fn = None
+        if cprofile_dir is not None:
+            cprofile_fn = os.path.join(cprofile_dir, student_dir + '.prof')
+        if use_pool:
+            (grade, reason, output), timing = grade_in_pool(student_path, cprofile_fn)
+        elif args.workers > 0:
+            (grade, reason, output), timing = grade_in_subprocess(
+                args, student_path, cprofile_fn=cprofile_fn)
+        else:
+            (grade, reason, output), timing = measure(
+                grade_student, student_path, cprofile_fn=cprofile_fn, shared=True)
+        if verbose:
+            print(f"Grading {student_dir}\n{output}Graded: {student_dir} got {grade}"
+                  + (f" ({reason})" if reason else ""))
+        if on_result is not None:
+            on_result(student_dir, (grade, reason, output))
+        return (grade, reason, output), timing
+
+    if args.workers > 0:
+        try:
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                graded = list(pool.map(grade_one, students))
+        finally:
+            for worker in all_workers:
+                if worker.is_alive():
+                    worker.close()
+    else:
+        graded = [grade_one(student_dir) for student_dir in students]
+    results = {student_dir: result for student_dir, (result, _) in zip(students, graded)}
+    timings = {student_dir: timing for student_dir, (_, timing) in zip(students, graded)}
+    return results, timings
+
+
+def write_timings(assignment_dir, timings):
+    """Writes the grading timings to timings.csv, returning its file name."""
+    csv_fn = os.path.join(assignment_dir, 'timings.csv')
     with open(csv_fn, 'w', newline='') as csvfile:
-        fieldnames=['student', 'grade']
+        fieldnames=['student', 'wall_s', 'cpu_s', 'peak_rss_mb']
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter='\t')
         writer.writeheader()
-        with os.scandir(args.assignment_dir) as it:
-            for entry in it:
-                if entry.is_dir() and "@" in entry.name:
-                    student_dir = entry.name
-                    print("Grading", student_dir)
-                    student_path = os.path.join(args.assignment_dir, student_dir)
-                    try:
-                        test = grader.Assignment(student_path)
-                        grade = test.grade()
-                    except Exception as e:
-                        grade = 0
-                        traceback.print_exc()
-                    print(f"Graded: {student_dir} got {grade}")
-                    writer.writerow({'student': student_dir, 'grade': grade})
-        print(f"Grades written to {csv_fn}")
+        for student_dir in sorted(timings):
+            row = {'student': student_dir}
+            for k, v in timings[student_dir].items():
+                row[k] = '' if v is None else f"{v:.3f}"
+            writer.writerow(row)
+    return csv_fn
+
+
+def main(args):
+    load_grader(args.grade_file)
+    students = list_students(args.assignment_dir)
+    selected = students
+    if args.students is not None:
+        wanted = {s.strip() for s in args.students.split(',')}
+        for student_dir in sorted(wanted - set(students)):
+            print(f"No submission for {student_dir}")
+        selected = [student_dir for student_dir in students if student_dir in wanted]
+    # Results are stored as soon as each student is graded.
+    grade_store = GradeStore(args.assignment_dir)
+    done = grade_store.start_run(resume=args.resume)
+    if done:
+        print(f"Resuming the interrupted run; {len(done)} students are already graded.")
+        selected = [student_dir for student_dir in selected if student_dir not in done]
+
+    # Finds the students whose results can be reused from the cache.
+    cache = None
+    store = BlobStore(args.store) if args.store else None
+    if args.invalidate or not args.no_cache:
+        cache = GradeCache(args.assignment_dir, store=store)
+        for student_dir in args.invalidate or []:
+            cache.invalidate(student_dir)
+    results = {}
+    hashes = {}
+    if not args.no_cache:
+        grader_hash = hash_file(args.grade_file + '.py')
+        for student_dir in selected:
+            hashes[student_dir] = cache.tree_hash(student_dir)
+            cached = cache.get(student_dir, hashes[student_dir], grader_hash)
+            if cached is not None:
+                results[student_dir] = cached
+                grade_store.put(student_dir, *cached)
+                grade, reason, output = cached
+                print(f"Cached: {student_dir} got {grade}" + (f" ({reason})" if reason else ""))
+    to_grade = [student_dir for student_dir in selected if student_dir not in results]
+    if store is not None:
+        # Graders may write into the submissions, which must not change the shared blobs.
+        copied = sum(store.unshare_tree(os.path.join(args.assignment_dir, student_dir))
+                     for student_dir in to_grade)
+        if copied:
+            print(f"Copied {copied} files shared with the store before grading them.")
+
+    graded, timings = grade_students(
+        args, to_grade, on_result=lambda student_dir, result: grade_store.put(student_dir, *result))
+    results.update(graded)
+    grade_store.finish_run()
+
+    if cache is not None:
+        if not args.no_cache:
+            # Failures (timeouts, crashes) are not cached, as they may be transient.
+            for student_dir in to_grade:
+                if results[student_dir][1]:
+                    continue
+                cache.put(student_dir, hashes[student_dir], grader_hash, *results[student_dir])
+        cache.close()
+    if store is not None:
+        store.close()
+
+    # The grades of all the students, including those graded in previous
+    # runs, are written in sorted order, whatever the order of grading.
+    csv_fn = os.path.join(args.assignment_dir, 'grades.csv')
+    num_written = grade_store.write_csv(csv_fn, students)
+    grade_store.close()
+    print(f"Grades of {num_written} students written to {csv_fn} "
+          f"({len(to_grade)} graded in this run, {len(results) - len(to_grade)} "
+          f"reused from the cache)")
+    if args.profile or args.cprofile_dir is not None:
+        print(f"Timings written to {write_timings(args.assignment_dir, timings)}")
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -36,7 +465,46 @@ if __name__ == '__main__':
                         help="grade.py file to use for grading (without the .py).")
     parser.add_argument('-d', '--assignment_dir', default=None,
                         help="Directory containing the student submissions.")
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help="Number of submissions to grade in parallel, each in its own "
+                        "subprocess.  If 0, grades in this process, one at a time.")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="Wall-clock time limit, in seconds, to grade each submission "
+                        "(only with --workers).")
+    parser.add_argument('--memory_limit', type=int, default=None,
+                        help="Memory limit, in MB, for grading each submission "
+                        "(only with --workers).")
+    parser.add_argument('--pool', action='store_true', default=False,
+                        help="With --workers, grade in warm worker processes, which import "
+                        "the grader once and grade several submissions each.")
+    parser.add_argument('--recycle_after', type=int, default=50,
+                        help="With --pool, replace each worker after it grades this many "
+                        "submissions.")
+    parser.add_argument('--recycle_mb', type=float, default=None,
+                        help="With --pool, replace a worker when its peak memory grows by "
+                        "more than this many MB (only on Linux).")
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help="Write the wall time, CPU time and peak RSS of grading each "
+                        "submission to timings.csv.")
+    parser.add_argument('--cprofile_dir', type=str, default=None,
+                        help="Dump the cProfile stats of grading each submission in this "
+                        "directory (implies --profile).")
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', default=False,
+                        help="Grade all submissions, ignoring and not updating the cache "
+                        "of previous results.")
+    parser.add_argument('--invalidate', action='append', default=None, metavar='STUDENT',
+                        help="Remove the cached result of a student (can be repeated).")
+    parser.add_argument('--students', type=str, default=None,
+                        help="Comma-separated list of the students to grade; the grades of "
+                        "the others are kept from previous runs.")
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help="If the previous run was interrupted, grade only the students "
+                        "it did not reach.")
+    parser.add_argument('--store', type=str, default=None,
+                        help="Content-addressed store used when downloading; the files shared "
+                        "with it need not be read to check the cache, and are copied before "
+                        "grading if they are hard links.")
 
     args = parser.parse_args()
     main(args)
-    
+
@@ -0,0 +1,165 @@
+"""Load-tests the tools against the local fake of Drive and Sheets.
+
+Generates a class of N students in a fake Drive and Sheets tree (see
+fake_google.py), each with a zipped submission made of shared starter
+code and of their own files, and runs the tools on it as subprocesses,
+as they are run in practice: downloading the submissions, uploading the
+feedback, running both again when nothing has changed, and listing the
+Drive sizes.  For each step, it reports the wall time, the throughput,
+and the requests made to the fake, including the 429 errors injected.
+Usage:
+
+python load_test.py -n 1000 --latency 0.05 --error_rate 0.01 -j 16 -w 8
+"""
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+SPREADSHEET_ID = 'class'
+STEPS = ['download', 'download_unchanged', 'feedback', 'feedback_unchanged', 'ls']
+
+
+def make_class(root_dir, num_students, files_per_submission, file_kb):
+    """Creates the fake Drive and Sheets tree of a class."""
+    submissions_dir = os.path.join(root_dir, 'drive', 'submissions')
+    os.makedirs(submissions_dir)
+    os.makedirs(os.path.join(root_dir, 'drive', 'feedback'))
+    sheets_dir = os.path.join(root_dir, 'sheets', SPREADSHEET_ID)
+    os.makedirs(sheets_dir)
+    starter = [(f"apps/starter/file{i}.py", (f"# starter {i}\n" * (file_kb * 64)).encode())
+               for i in range(files_per_submission)]
+    responses, grades = [], []
+    for i in range(num_students):
+        email = f"student{i:04d}@load.invalid"
+        zip_fn = os.path.join(submissions_dir, email + '.zip')
+        with zipfile.ZipFile(zip_fn, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, content in starter:
+                zf.writestr(name, content)
+            zf.writestr("apps/starter/controllers.py", f"# work of {email}\n" * (file_kb * 32))
+        responses.append(['2024-01-01 00:00:00', email,
+                          'https://drive.google.com/open?id=submissions/' + email + '.zip'])
+        grades.append([email, str(i % 11), f"Comments for {email}"])
+    with open(os.path.join(sheets_dir, 'Form Responses 1.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Timestamp', 'Email Address', 'Submission'])
+        writer.writerows(responses)
+    with open(os.path.join(sheets_dir, 'Feedback.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Email', 'Grade', 'Comments'])
+        writer.writerows(grades)
+    template_fn = os.path.join(root_dir, 'feedback_template.txt')
+    with open(template_fn, 'w') as f:
+        f.write("Dear {Email},\n\nyour grade is {Grade}.\n\n{Comments}\n")
+    return template_fn
+
+
+def step_commands(args, root_dir, template_fn):
+    """Returns the command of each step."""
+    out_dir = os.path.join(root_dir, 'out')
+    download = ['download_submissions.py', '-s', SPREADSHEET_ID, '-d', out_dir,
+                '-j', str(args.jobs)]
+    if args.stream:
+        download.append('--stream')
+    feedback = ['upload_feedback.py', '-s', SPREADSHEET_ID, '--sheet', 'Feedback',
+                '-f', template_fn, '-d', 'feedback', '-w', str(args.workers),
+                '--qps', str(args.qps),
+                '--index_file', os.path.join(root_dir, 'feedback_index.json')]
+    return {
+        'download': download,
+        'download_unchanged': download,
+        'feedback': feedback,
+        'feedback_unchanged': feedback,
+        'ls': ['ls.py', 'root', '-d', '2', '-j', str(args.jobs)],
+    }
+
+
+def run_step(name, command, env, root_dir):
+    """Runs a step, returning its wall time and the requests it made."""
+    stats_fn = os.path.join(root_dir, f"stats_{name}.json")
+    env = dict(env, CLASS_TOOLS_FAKE_STATS=stats_fn)
+    t0 = time.time()
+    result = subprocess.run([sys.executable] + [os.path.join(TOOLS_DIR, command[0])] + command[1:],
+                            env=env, cwd=root_dir, capture_output=True, text=True)
+    elapsed = time.time() - t0
+    if result.returncode != 0:
+        print(result.stdout[-2000:])
+        print(result.stderr[-2000:])
+        raise RuntimeError(f"Step {name} failed with exit code {result.returncode}")
+    stats = {}
+    if os.path.exists(stats_fn):
+        with open(stats_fn, 'r') as f:
+            stats = json.load(f)
+    return elapsed, stats
+
+
+def main(args):
+    root_dir = args.dir or tempfile.mkdtemp(prefix='load_test_')
+    if os.path.exists(root_dir) and os.listdir(root_dir):
+        print(f"{root_dir} is not empty")
+        return
+    try:
+        t0 = time.time()
+        template_fn = make_class(root_dir, args.num_students, args.files, args.file_kb)
+        print(f"Generated {args.num_students} students in {root_dir} in {time.time() - t0:.1f}s")
+        env = dict(os.environ,
+                   CLASS_TOOLS_FAKE_BACKEND=root_dir,
+                   CLASS_TOOLS_FAKE_LATENCY=str(args.latency),
+                   CLASS_TOOLS_FAKE_ERROR_RATE=str(args.error_rate),
+                   CLASS_TOOLS_FAKE_MAX_QPS='' if args.max_qps is None else str(args.max_qps))
+        commands = step_commands(args, root_dir, template_fn)
+        print(f"{'step':20s} {'total_s':>8s} {'students/s':>11s} {'requests':>9s} {'429s':>6s}")
+        for name in args.steps.split(','):
+            elapsed, stats = run_step(name, commands[name], env, root_dir)
+            requests = sum(n for method, n in stats.items() if method != '429')
+            print(f"{name:20s} {elapsed:8.2f} {args.num_students / elapsed:11.1f} "
+                  f"{requests:9d} {stats.get('429', 0):6d}")
+            if args.verbose:
+                for method, n in sorted(stats.items()):
+                    print(f"    {method:30s} {n:6d}")
+    finally:
+        if not args.keep and not args.dir:
+            shutil.rmtree(root_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_students', type=int, default=1000,
+                        help="Number of students in the class.")
+    parser.add_argument('--files', type=int, default=10,
+                        help="Number of starter files in each submission.")
+    parser.add_argument('--file_kb', type=int, default=4,
+                        help="Approximate size, in KB, of each file.")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Mean latency, in seconds, of each request to the fake.")
+    parser.add_argument('--error_rate', type=float, default=0.0,
+                        help="Fraction of the requests that fail with 429.")
+    parser.add_argument('--max_qps', type=float, default=None,
+                        help="Requests per second beyond which the fake fails with 429.")
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help="Concurrent downloads and listings.")
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help="Concurrent feedback uploads.")
+    parser.add_argument('--qps', type=float, default=20.0,
+                        help="Maximum rate of feedback requests per second.")
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help="Unzip the submissions while downloading them.")
+    parser.add_argument('--steps', type=str, default=','.join(STEPS),
+                        help="Comma-separated list of the steps to run, among " + ', '.join(STEPS))
+    parser.add_argument('--dir', type=str, default=None,
+                        help="Directory where to generate the class (default: a temporary "
+                        "directory, removed at the end).")
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help="Keep the temporary directory.")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="Print the number of requests by method.")
+    args = parser.parse_args()
+    main(args)
@@ -4,10 +4,16 @@
 """
 Usage: 
 
-python ls.py <dir_id> [-d <depth>] [-a]
+python ls.py <dir_id> [-d <depth>] [-a] [-j <jobs>]
 
 -d: maximum depth at which to inspect directories.  Default is 1.
 -a: list all directories, not just the top one. 
+-j: number of Drive queries to run in parallel.  Default is 8.
+--cache_file <file>: cache the Drive metadata in <file>, so that later runs
+    only read what changed in Drive.
+--cached: answer from the cache only, without accessing Drive.
+--trace <file>, --metrics, --prometheus <file>: record the Drive requests
+    (see api_metrics.py).
 
 To use this script, you need to create credentials for Google Drive.
 Here is how to proceed: 
@@ -32,18 +38,21 @@ References:
 """
 
 import argparse
-import io
-import os
-import pickle
-import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
+from googleapiclient.errors import HttpError
+
+import api_metrics
+from drive_cache import DriveCache
+from google_services import get_credentials, print_timing, thread_service
 
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/drive']
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+# Number of folders whose children are listed with a single query.
+PARENTS_PER_QUERY = 50
+DEFAULT_CACHE_FILE = 'ls_cache.sqlite'
 
 
 def hsize(size):
@@ -62,39 +71,142 @@ def sanitize(s):
     return s
 
 
-def list_dir(dir_id, path, depth, args):
-    """List the contents of a directory dir_id, returning the total 
-    size of the files in there."""
-    depth += 1
-    # Creates a query. 
-    q = f"'{dir_id}' in parents" if dir_id != "root" else "'root' in parents"
+def get_drive_service():
+    """Returns the Drive service of the current thread, as httplib2 is not
+    thread-safe."""
+    return thread_service('drive', 'v3', creds)
+
+
+def list_children(parent_ids):
+    """Lists the children of the given folders with a single query,
+    returning a dictionary from each parent id to the list of its children."""
+    q = " or ".join(f"'{parent_id}' in parents" for parent_id in parent_ids)
+    children = {parent_id: [] for parent_id in parent_ids}
     page_token = None
-    total_size = 0
     while True:
-        response = drive_service.files().list(
+        response = get_drive_service().files().list(
             q=q,
             spaces='drive',
-            fields='nextPageToken, files(id, name, size, mimeType)',
+            pageSize=1000,
+            fields='nextPageToken, files(id, name, size, mimeType, modifiedTime, parents)',
             pageToken=page_token).execute()
         for file in response.get('files', []):
-            if file.get('mimeType') == 'application/vnd.google-apps.folder':
-                if depth is not None and depth > args.depth:
-                    continue
-                t = list_dir(file.get('id'), path + file.get('name', '') + "/", depth, args)
-                total_size += t
-                if t > 0 and (args.all or depth <= 1):
-                    print(f"{hsize(t)} \t{path}{sanitize(file.get('name'))}")
+            if len(parent_ids) == 1:
+                # The parent may have been given by an alias, such as 'root'.
+                children[parent_ids[0]].append(file)
             else:
-                total_size += int(file.get('size', 0))
+                for parent_id in file.get('parents', []):
+                    if parent_id in children:
+                        children[parent_id].append(file)
         page_token = response.get('nextPageToken', None)
         if page_token is None:
             break
+    return children
+
+
+def list_tree(dir_id, max_depth, jobs, cache=None, offline=False):
+    """Lists the tree rooted at dir_id, down to max_depth, one level at a
+    time, listing the folders of each level in parallel.  Returns a
+    dictionary from folder id to the list of its children.
+    If a cache is given, the folders in it are not listed again, and
+    the ones that are listed are added to it.  If offline, folders that
+    are not in the cache are considered empty."""
+    children = {}
+    level = [dir_id]
+    depth = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while level:
+            missing = level
+            if cache is not None:
+                missing = []
+                for folder_id in level:
+                    cached = cache.children(folder_id)
+                    if cached is None:
+                        missing.append(folder_id)
+                    else:
+                        children[folder_id] = cached
+            if offline:
+                if missing:
+                    print(f"Warning: {len(missing)} folders are not in the cache.")
+                children.update((folder_id, []) for folder_id in missing)
+            else:
+                chunks = [missing[i:i + PARENTS_PER_QUERY]
+                          for i in range(0, len(missing), PARENTS_PER_QUERY)]
+                for result in pool.map(list_children, chunks):
+                    children.update(result)
+                    if cache is not None:
+                        cache.store_listing(result)
+            depth += 1
+            if depth > max_depth:
+                break
+            # Folders can have more than one parent, so we list each only once.
+            level = list(dict.fromkeys(
+                file['id'] for folder_id in level for file in children[folder_id]
+                if file.get('mimeType') == FOLDER_MIME and file['id'] not in children))
+    return children
+
+
+def fold_sizes(children, dir_id, path, depth, args):
+    """Computes the total size of the files in dir_id, printing the sizes
+    of its subfolders as requested by args."""
+    depth += 1
+    total_size = 0
+    for file in children[dir_id]:
+        if file.get('mimeType') == FOLDER_MIME:
+            if depth is not None and depth > args.depth:
+                continue
+            t = fold_sizes(children, file.get('id'), path + file.get('name', '') + "/", depth, args)
+            total_size += t
+            if t > 0 and (args.all or depth <= 1):
+                print(f"{hsize(t)} \t{path}{sanitize(file.get('name'))}")
+        else:
+            total_size += int(file.get('size', 0))
     return total_size
 
 
+def list_dir(dir_id, path, depth, args, cache=None):
+    """List the contents of a directory dir_id, returning the total 
+    size of the files in there."""
+    children = list_tree(dir_id, args.depth - depth, args.jobs,
+                         cache=cache, offline=args.cached)
+    return fold_sizes(children, dir_id, path, depth, args)
+
+
+def open_cache(args):
+    """Opens the metadata cache, bringing it up to date unless we are
+    working offline.  Returns the cache and the id of the directory
+    to list, with aliases such as 'root' resolved."""
+    cache = DriveCache(args.cache_file)
+    alias_key = 'alias:' + args.dir_id
+    if args.cached:
+        return cache, cache.get_meta(alias_key) or args.dir_id
+    try:
+        num_changes = cache.apply_changes(get_drive_service())
+        print(f"Applied {num_changes} changes to the cache.")
+    except HttpError as e:
+        print(f"Could not read the Drive changes ({e}); rebuilding the cache.")
+        cache.clear()
+        cache.start_changes(get_drive_service())
+    # The changes feed refers to folders by id, not by alias.
+    dir_id = get_drive_service().files().get(fileId=args.dir_id, fields='id, name').execute()
+    cache.set_meta(alias_key, dir_id['id'])
+    cache.set_meta('name:' + dir_id['id'], dir_id['name'])
+    return cache, dir_id['id']
+
+
 def main(args):
-    t = list_dir(args.dir_id, "", 0, args)
-    filename = drive_service.files().get(fileId=args.dir_id).execute().get('name')
+    cache, dir_id = None, args.dir_id
+    if args.cached and args.cache_file is None:
+        args.cache_file = DEFAULT_CACHE_FILE
+    if args.cache_file is not None:
+        cache, dir_id = open_cache(args)
+    t = list_dir(dir_id, "", 0, args, cache=cache)
+    if args.cached:
+        filename = cache.get_meta('name:' + dir_id) or dir_id
+    else:
+        filename = get_drive_service().files().get(fileId=dir_id).execute().get('name')
+    if cache is not None:
+        cache.close()
     print(f"Total size of {filename}: {hsize(t)}")
 
     
@@ -104,28 +216,26 @@ if __name__ == '__main__':
                         help="Depth limit for recursion.")
     parser.add_argument('-a', '--all', action='store_true',
                         help="List all directory sizes.")
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help="Number of queries to Drive to run in parallel.")
+    parser.add_argument('--timing', action='store_true', default=False,
+                        help="Print the time taken to load the credentials and services.")
+    parser.add_argument('--cache_file', type=str, default=None,
+                        help="SQLite file where to cache the Drive metadata across runs.")
+    parser.add_argument('--cached', action='store_true', default=False,
+                        help="Answer from the cache only, without accessing Drive "
+                        f"(the cache file defaults to {DEFAULT_CACHE_FILE}).")
+    api_metrics.add_arguments(parser)
     parser.add_argument('dir_id', default="root",)
     args = parser.parse_args()
-    # Auth code. 
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-            except:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    'credentials.json', SCOPES)
-                creds = flow.run_local_server()
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server()
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-    drive_service = build('drive', 'v3', credentials=creds)
+    if args.cached:
+        main(args)
+        sys.exit(0)
+    api_metrics.start(args)
+    creds = get_credentials(SCOPES)
+    if args.timing:
+        get_drive_service()
+        print_timing()
     main(args)
+    api_metrics.finish(args)
     
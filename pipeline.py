@@ -0,0 +1,264 @@
+"""Downloads, grades, and uploads feedback for an assignment in one command.
+
+Each student flows through the stages download (and unzip), grade, and
+feedback (render and upload).  Each stage has its own bounded queue and
+pool of workers, so that, for instance, downloading a submission
+overlaps with grading the previous ones.  At the end, the throughput and
+latency of each stage are reported.
+"""
+
+import argparse
+import os
+import queue
+import threading
+import time
+
+
+import api_metrics
+import download_submissions
+import grade_submissions
+from file_distributor import FileDistributor
+from grade_store import GradeStore
+from google_services import build_service, get_credentials, print_timing
+from upload_feedback import FeedbackTemplate
+
+# If modifying these scopes, delete the file token.pickle.
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly',
+          'https://www.googleapis.com/auth/drive']
+
+# Fields that the feedback template can use.
+FEEDBACK_FIELDS = {'email', 'grade', 'reason', 'output'}
+# Signals to the workers of a stage that there is no more work.
+_STOP = object()
+
+
+class Stage(object):
+    """A pipeline stage, in which workers take items from the inbox,
+    process them, and pass the results to the next stage."""
+
+    def __init__(self, name, func, workers, queue_size):
+        self.name = name
+        self.func = func
+        self.num_workers = max(1, workers)
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.latencies = []
+        self.errors = 0
+        self.failed = []
+        self.time_start = None
+        self.time_end = None
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self, next_stage=None):
+        for _ in range(self.num_workers):
+            t = threading.Thread(target=self._run, args=(next_stage,), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        """Waits for all the items to be processed, and stops the workers."""
+        for _ in self.threads:
+            self.inbox.put(_STOP)
+        for t in self.threads:
+            t.join()
+
+    def _run(self, next_stage):
+        while True:
+            item = self.inbox.get()
+            if item is _STOP:
+                return
+            t0 = time.time()
+            with self.lock:
+                if self.time_start is None:
+                    self.time_start = t0
+            try:
+                self.func(item)
+            except Exception as e:
+                item['reason'] = item.get('reason') or f"{self.name} error: {e!r}"
+                print(f"Error in {self.name} for {item['email']}: {e!r}")
+                with self.lock:
+                    self.errors += 1
+                    self.failed.append(item['email'])
+            t1 = time.time()
+            with self.lock:
+                self.latencies.append(t1 - t0)
+                self.time_end = t1
+            if next_stage is not None:
+                next_stage.inbox.put(item)
+
+    def report(self):
+        """Returns a line summarizing the throughput and latency of the stage."""
+        n = len(self.latencies)
+        if n == 0:
+            return f"{self.name:10s} no items"
+        latencies = sorted(self.latencies)
+        elapsed = max(self.time_end - self.time_start, 1e-9)
+        return (f"{self.name:10s} {n} items, {self.errors} errors, "
+                f"{n / elapsed:.2f} items/s over {elapsed:.1f}s, latency "
+                f"mean {sum(latencies) / n:.2f}s p50 {latencies[n // 2]:.2f}s "
+                f"p95 {latencies[min(n - 1, int(n * 0.95))]:.2f}s")
+
+
+def main(args):
+    # Checks the feedback template first, rather than failing after grading.
+    with open(args.feedback, 'r') as f:
+        template = FeedbackTemplate(f.read())
+    unknown = sorted(template.fields() - FEEDBACK_FIELDS)
+    if unknown:
+        print(f"The feedback template refers to {unknown}; it can only use "
+              f"{sorted(FEEDBACK_FIELDS)}.")
+        return
+    creds = get_credentials(SCOPES)
+
+    sheet_service = build_service('sheets', 'v4', creds)
+    if args.timing:
+        print_timing()
+    student_submissions = download_submissions.read_submissions(sheet_service, args)
+    api_metrics.metrics.students = len(student_submissions)
+    if not student_submissions:
+        print('No data found.')
+        return
+    if not os.path.exists(args.destination_dir):
+        os.makedirs(args.destination_dir)
+    # Imports the grader before starting, so that errors in it are reported at once.
+    grade_submissions.load_grader(args.grade_file)
+
+    grade_store = GradeStore(args.destination_dir)
+    grade_store.start_run()
+    workers = download_submissions.DriveWorkers(creds)
+    progress = download_submissions.Progress(len(student_submissions))
+    distributor = None
+    if not args.test:
+        # A single distributor, whose threads each get their own service,
+        # rate limits and retries the requests of all the upload workers.
+        distributor = FileDistributor(workers.service(), args.share_folder_id,
+                                      service_factory=workers.service,
+                                      qps=args.upload_qps)
+        distributor.index # Loads the index before the workers need it.
+
+    # The metadata of all submissions is fetched up front, in batches.
+    docids = {email: download_submissions.parse_docid(url)
+              for email, url in student_submissions.items()}
+    metadata = download_submissions.fetch_metadata(workers.service(), docids.values())
+
+    def download(item):
+        item['status'] = download_submissions.process_submission(
+            workers, item['email'], item['docid'], args, progress,
+            meta=metadata.get(item['docid']))
+
+    def grade(item):
+        student_path = os.path.join(args.destination_dir, item['email'])
+        if item['status'] != 'ok':
+            item['grade'], item['reason'] = 0, item['reason'] or item['status']
+        elif not os.path.isdir(student_path):
+            # Google Docs and the like are exported, not unzipped.
+            item['grade'], item['reason'] = 0, "The submission is not a zip file"
+        else:
+            (item['grade'], item['reason'], item['output']), _ = (
+                grade_submissions.grade_in_subprocess(args, student_path))
+        grade_store.put(item['email'], item['grade'], item['reason'], item['output'])
+
+    def upload(item):
+        text = template.render(item)
+        if args.test:
+            print("Feedback for", item['email'], ":")
+            print(text)
+            return
+        distributor.distribute_bytes(
+            item['email'], text.encode('utf-8'), f"feedback_{item['email']}.txt",
+            mime='text/plain', mode='reader', update=True)
+
+    stages = [Stage('download', download, args.download_jobs, args.queue_size),
+              Stage('grade', grade, args.grade_workers, args.queue_size),
+              Stage('feedback', upload, args.upload_jobs, args.queue_size)]
+    for stage, next_stage in zip(stages, stages[1:] + [None]):
+        stage.start(next_stage)
+    time0 = time.time()
+    items = [{'email': email, 'docid': docid, 'status': "",
+              'grade': 0, 'reason': "", 'output': ""}
+             for email, docid in docids.items()]
+    for item in items:
+        # Blocks when the download queue is full.
+        stages[0].inbox.put(item)
+    for stage in stages:
+        stage.stop()
+    print()
+
+    # Writes the grades, merged with those of previous runs, as grade_submissions.py does.
+    grade_store.finish_run()
+    csv_fn = os.path.join(args.destination_dir, 'grades.csv')
+    # Students whose download failed have no directory, but have a grade.
+    students = set(grade_submissions.list_students(args.destination_dir))
+    grade_store.write_csv(csv_fn, sorted(students | {item['email'] for item in items}))
+    grade_store.close()
+    print(f"Grades written to {csv_fn}")
+    print(f"Processed {len(items)} students in {time.time() - time0:.1f}s")
+    for stage in stages:
+        print(stage.report())
+    for stage in stages:
+        if stage.failed:
+            print(f"Failed in {stage.name}: {', '.join(sorted(stage.failed))}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--spreadsheet_id', default=None,
+                        help="ID of the spreadsheet with the submissions form responses.")
+    parser.add_argument('-m', '--email_column', default='B',
+                        help='Column containing email')
+    parser.add_argument('-f', '--file_column', default='C',
+                        help='Column containing submission')
+    parser.add_argument('--sheet', type=str, default='Form Responses 1',
+                        help='Sheet name')
+    parser.add_argument('-d', '--destination_dir', type=str, default='.',
+                        help='Directory where to store the submissions.')
+    parser.add_argument('-g', '--grade_file', default=None,
+                        help="grade.py file to use for grading (without the .py).")
+    parser.add_argument('--feedback', type=str, default=None,
+                        help="Feedback template; it can refer to {email}, {grade}, "
+                        "{reason}, and {output}.")
+    parser.add_argument('--share_folder_id', type=str, default=None,
+                        help='Folder ID in Drive where to put the feedback.')
+    parser.add_argument('-t', '--test', action='store_true', default=False,
+                        help="Print the feedback rather than sharing it.")
+    parser.add_argument('--students', type=str, default=None,
+                        help='Comma-separated list of student emails to process. '
+                        'If not specified, all students are processed.')
+    parser.add_argument('--timing', action='store_true', default=False,
+                        help='Print the time taken to load the credentials and services.')
+    parser.add_argument('--download_jobs', type=int, default=4,
+                        help='Number of submissions to download concurrently.')
+    parser.add_argument('--grade_workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of submissions to grade in parallel.')
+    parser.add_argument('--upload_jobs', type=int, default=2,
+                        help='Number of feedback files to upload concurrently.')
+    parser.add_argument('--upload_qps', type=float, default=5.0,
+                        help='Maximum number of Drive requests per second to upload '
+                        'the feedback.')
+    parser.add_argument('--queue_size', type=int, default=8,
+                        help='Maximum number of students waiting for each stage.')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="Wall-clock time limit, in seconds, to grade each submission.")
+    parser.add_argument('--memory_limit', type=int, default=None,
+                        help="Memory limit, in MB, for grading each submission.")
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='Unzip the submissions directly from the download.')
+    parser.add_argument('--spool_mb', type=float, default=64,
+                        help='With --stream, downloads larger than this many MB are '
+                        'buffered on disk rather than in memory.')
+    parser.add_argument('--include', action='append', default=None, metavar='GLOB',
+                        help='Only extract the files matching this glob (can be repeated).')
+    parser.add_argument('--exclude', action='append', default=None, metavar='GLOB',
+                        help='Do not extract the files matching this glob (can be repeated).')
+    parser.add_argument('--max_unzipped_mb', type=float, default=None,
+                        help='Reject submissions whose uncompressed size exceeds this many MB.')
+    parser.add_argument('--max_download_mb', type=float, default=None,
+                        help='Do not download submissions larger than this many MB.')
+    api_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    # Submissions are always downloaded as zip files, and unzipped.
+    args.extension = 'zip'
+    args.no_unzip = False
+    api_metrics.start(args)
+    main(args)
+    api_metrics.finish(args)
@@ -0,0 +1,74 @@
+"""Reads only the needed columns and rows of a Google sheet.
+
+Columns can be given either by header name or by letter ('B'); the
+header row is read once and cached, and header names take precedence.  The columns are fetched
+with a single batchGet, and reading can start from a given row, so that
+incremental runs only fetch the new form responses.
+"""
+
+import re
+
+_LETTERS = re.compile(r'^[A-Z]{1,3}$')
+
+
+def column_letter(index):
+    """Returns the letter of the column with the given 0-based index."""
+    letters = ''
+    index += 1
+    while index > 0:
+        index, r = divmod(index - 1, 26)
+        letters = chr(ord('A') + r) + letters
+    return letters
+
+
+class SheetReader(object):
+
+    def __init__(self, sheet_service, spreadsheet_id, sheet):
+        self.sheet_service = sheet_service
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet = sheet
+        self._headers = None
+
+    def _range(self, cells):
+        """Returns the A1 notation of cells in the sheet."""
+        return "'%s'!%s" % (self.sheet.replace("'", "''"), cells)
+
+    def headers(self):
+        """Returns the header row, reading it only once."""
+        if self._headers is None:
+            result = self.sheet_service.spreadsheets().values().get(
+                spreadsheetId=self.spreadsheet_id,
+                range=self._range('1:1')).execute()
+            values = result.get('values', [])
+            self._headers = values[0] if values else []
+        return self._headers
+
+    def resolve(self, column):
+        """Returns the letter of a column, given by header name or by letter.
+        Header names come first, so that a header such as 'URL' or 'ID'
+        is not mistaken for a column letter."""
+        headers = self.headers()
+        if column in headers:
+            return column_letter(headers.index(column))
+        if _LETTERS.match(column):
+            return column
+        raise KeyError(f"No column {column!r} in sheet {self.sheet!r}; the columns are {headers}")
+
+    def read_columns(self, columns, first_row=2):
+        """Reads the given columns, from first_row (1-based) to the end of
+        the sheet.  Returns a list of (row_number, values), where values
+        has one entry per column ('' for empty cells)."""
+        letters = [self.resolve(c) for c in columns]
+        ranges = [self._range(f"{c}{first_row}:{c}") for c in letters]
+        result = self.sheet_service.spreadsheets().values().batchGet(
+            spreadsheetId=self.spreadsheet_id, ranges=ranges,
+            majorDimension='COLUMNS').execute()
+        data = []
+        for value_range in result.get('valueRanges', []):
+            values = value_range.get('values', [])
+            data.append(values[0] if values else [])
+        num_rows = max((len(col) for col in data), default=0)
+        rows = []
+        for i in range(num_rows):
+            rows.append((first_row + i, [col[i] if i < len(col) else '' for col in data]))
+        return rows
@@ -0,0 +1,265 @@
+"""Finds pairs of submissions that share suspiciously much code.
+
+Each file is reduced to a set of fingerprints by winnowing (Schleimer,
+Wilkerson, and Aiken, 2003): the file is tokenized, identifiers and
+literals are normalized so that renaming variables does not hide a copy,
+the hashes of all k-grams of tokens are computed, and the minimum hash of
+each window of w consecutive k-grams is kept.  The fingerprints of the
+starter code, given as a baseline directory, are discarded.  Pairs of
+students are then found through an inverted index from fingerprint to
+students, rather than by comparing all pairs, and ranked by the fraction
+of the fingerprints of the smaller submission that they share.
+
+Fingerprints are cached per file content, so running the tool again after
+late submissions only fingerprints the new files.  Usage:
+
+python similarity.py -d <submission_folder> -b ../assignment1/ --top 20
+"""
+
+import argparse
+import array
+import csv
+import hashlib
+import io
+import keyword
+import os
+import re
+import sqlite3
+import sys
+import tokenize
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from grade_cache import IGNORED_DIRS, hash_file
+
+# Name of the fingerprint cache, in the assignment directory.
+CACHE_NAME = '.similarity_cache.sqlite'
+# Changing the normalization must invalidate the cached fingerprints.
+FINGERPRINT_VERSION = 1
+DEFAULT_EXTENSIONS = 'py,html,js,css'
+_PY_KEYWORDS = frozenset(keyword.kwlist)
+_TEXT_TOKEN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|\d+|\S')
+
+
+def python_tokens(text):
+    """Returns the normalized tokens of Python code: identifiers, numbers,
+    and strings are replaced by placeholders, and comments are dropped."""
+    tokens = []
+    for tok in tokenize.generate_tokens(io.StringIO(text).readline):
+        if tok.type == tokenize.NAME:
+            tokens.append(tok.string if tok.string in _PY_KEYWORDS else 'V')
+        elif tok.type == tokenize.NUMBER:
+            tokens.append('N')
+        elif tok.type == tokenize.STRING:
+            tokens.append('S')
+        elif tok.type == tokenize.OP:
+            tokens.append(tok.string)
+        elif tok.type in (tokenize.INDENT, tokenize.DEDENT):
+            tokens.append(tokenize.tok_name[tok.type])
+    return tokens
+
+
+def text_tokens(text):
+    """Returns the tokens of other text files, with identifiers kept, as
+    in templates they are mostly markup and not variables."""
+    return _TEXT_TOKEN.findall(text.lower())
+
+
+def tokens_of(path, text):
+    if path.endswith('.py'):
+        try:
+            return python_tokens(text)
+        except (tokenize.TokenError, IndentationError, SyntaxError):
+            pass # Not valid Python: falls back to plain text.
+    return text_tokens(text)
+
+
+def winnow(tokens, k, w):
+    """Returns the sorted winnowing fingerprints of a list of tokens."""
+    hashes = []
+    for i in range(len(tokens) - k + 1):
+        gram = '\0'.join(tokens[i:i + k]).encode('utf-8', 'surrogateescape')
+        # The builtin hash() differs across processes, so it cannot be used.
+        hashes.append(int.from_bytes(hashlib.blake2b(gram, digest_size=8).digest(), 'little'))
+    if len(hashes) <= w:
+        return [min(hashes)] if hashes else []
+    fingerprints = set()
+    for i in range(len(hashes) - w + 1):
+        fingerprints.add(min(hashes[i:i + w]))
+    return sorted(fingerprints)
+
+
+def fingerprint_file(path, k, w):
+    """Returns the fingerprints of a file, as an array of 64-bit ints."""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        text = f.read()
+    return array.array('Q', winnow(tokens_of(path, text), k, w))
+
+
+def list_files(root_dir, extensions):
+    """Returns the files of root_dir with the given extensions."""
+    paths = []
+    for root, dirs, files in os.walk(root_dir):
+        dirs[:] = sorted(d for d in dirs if d not in IGNORED_DIRS)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.endswith(extensions) and os.path.isfile(path) and not os.path.islink(path):
+                paths.append(path)
+    return paths
+
+
+class FingerprintCache(object):
+
+    def __init__(self, cache_file, k, w):
+        """Opens (creating it if needed) the cache of fingerprints computed
+        with k-grams of k tokens and windows of w k-grams."""
+        self.params = f"{FINGERPRINT_VERSION}:{k}:{w}"
+        self.db = sqlite3.connect(cache_file)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS fingerprints (
+            digest TEXT, params TEXT, data BLOB, PRIMARY KEY (digest, params))""")
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def get(self, digest):
+        row = self.db.execute("SELECT data FROM fingerprints WHERE digest = ? AND params = ?",
+                              (digest, self.params)).fetchone()
+        if row is None:
+            return None
+        fingerprints = array.array('Q')
+        fingerprints.frombytes(row[0])
+        return fingerprints
+
+    def put(self, digest, fingerprints):
+        self.db.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)",
+                        (digest, self.params, fingerprints.tobytes()))
+
+
+def fingerprint_all(paths, cache, k, w, jobs):
+    """Returns a dictionary from path to fingerprints, computing in jobs
+    processes those that are not in the cache."""
+    digests = {path: hash_file(path) for path in paths}
+    by_digest = {}
+    for digest in set(digests.values()):
+        fingerprints = cache.get(digest)
+        if fingerprints is not None:
+            by_digest[digest] = fingerprints
+    # Files with the same content are fingerprinted only once.
+    todo = {}
+    for path, digest in digests.items():
+        if digest not in by_digest:
+            todo.setdefault(digest, path)
+    print(f"Fingerprinting {len(todo)} files ({len(set(digests.values())) - len(todo)} cached)")
+    if todo:
+        todo_paths = list(todo.values())
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = pool.map(fingerprint_file, todo_paths, [k] * len(todo_paths),
+                               [w] * len(todo_paths), chunksize=16)
+            for digest, fingerprints in zip(todo, results):
+                by_digest[digest] = fingerprints
+                cache.put(digest, fingerprints)
+        cache.db.commit()
+    return {path: by_digest[digest] for path, digest in digests.items()}
+
+
+def find_pairs(student_fingerprints, max_students):
+    """Returns a dictionary from pairs of students to the number of
+    fingerprints they share, ignoring the fingerprints that occur in more
+    than max_students submissions, as they are common idioms."""
+    index = defaultdict(list)
+    for student, fingerprints in student_fingerprints.items():
+        for fp in fingerprints:
+            index[fp].append(student)
+    shared = defaultdict(int)
+    for students in index.values():
+        if len(students) < 2 or len(students) > max_students:
+            continue
+        students.sort()
+        for i, a in enumerate(students):
+            for b in students[i + 1:]:
+                shared[a, b] += 1
+    return shared
+
+
+def main(args):
+    extensions = tuple('.' + e.strip().lstrip('.') for e in args.extensions.split(','))
+    students = sorted(d for d in os.listdir(args.assignment_dir)
+                      if "@" in d and os.path.isdir(os.path.join(args.assignment_dir, d)))
+    files = {student: list_files(os.path.join(args.assignment_dir, student), extensions)
+             for student in students}
+    baseline_files = list_files(args.baseline_dir, extensions) if args.baseline_dir else []
+    all_paths = baseline_files + [path for paths in files.values() for path in paths]
+    cache = FingerprintCache(os.path.join(args.assignment_dir, CACHE_NAME), args.k, args.window)
+    fingerprints = fingerprint_all(all_paths, cache, args.k, args.window, args.jobs)
+    cache.close()
+
+    baseline = set()
+    for path in baseline_files:
+        baseline.update(fingerprints[path])
+    student_fingerprints = {}
+    for student, paths in files.items():
+        fps = set()
+        for path in paths:
+            fps.update(fingerprints[path])
+        student_fingerprints[student] = fps - baseline
+    max_students = max(2, int(args.max_share * len(students)))
+    shared = find_pairs(student_fingerprints, max_students)
+
+    pairs = []
+    for (a, b), n in shared.items():
+        size_a, size_b = len(student_fingerprints[a]), len(student_fingerprints[b])
+        if min(size_a, size_b) < args.min_fingerprints:
+            continue
+        containment = n / min(size_a, size_b)
+        jaccard = n / (size_a + size_b - n)
+        if containment >= args.threshold:
+            pairs.append((containment, jaccard, n, a, b))
+    pairs.sort(reverse=True)
+
+    csv_fn = os.path.join(args.assignment_dir, 'similarity.csv')
+    with open(csv_fn, 'w', newline='') as csvfile:
+        fieldnames = ['student1', 'student2', 'containment', 'jaccard', 'shared']
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter='\t')
+        writer.writeheader()
+        for containment, jaccard, n, a, b in pairs:
+            writer.writerow({'student1': a, 'student2': b, 'containment': f"{containment:.3f}",
+                             'jaccard': f"{jaccard:.3f}", 'shared': n})
+    for containment, jaccard, n, a, b in pairs[:args.top]:
+        print(f"{containment:6.1%} {jaccard:6.1%} {n:6d}  {a}  {b}")
+    print(f"{len(pairs)} suspicious pairs written to {csv_fn}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--assignment_dir', type=str, default='.',
+                        help="Directory with the student submissions.")
+    parser.add_argument('-b', '--baseline_dir', type=str, default=None,
+                        help="Directory with the starter code, whose fingerprints are ignored.")
+    parser.add_argument('--extensions', type=str, default=DEFAULT_EXTENSIONS,
+                        help="Comma-separated list of the extensions of the files to compare.")
+    parser.add_argument('-k', type=int, default=12,
+                        help="Number of tokens in each k-gram; matches shorter than this "
+                        "are ignored.")
+    parser.add_argument('--window', type=int, default=8,
+                        help="Winnowing window, in k-grams; matches at least k + window - 1 "
+                        "tokens long are always detected.")
+    parser.add_argument('--max_share', type=float, default=0.1,
+                        help="Ignore fingerprints found in more than this fraction of the "
+                        "submissions.")
+    parser.add_argument('--min_fingerprints', type=int, default=10,
+                        help="Ignore submissions with fewer fingerprints than this, once "
+                        "the baseline is removed.")
+    parser.add_argument('--threshold', type=float, default=0.3,
+                        help="Report the pairs sharing at least this fraction of the "
+                        "fingerprints of the smaller submission.")
+    parser.add_argument('--top', type=int, default=20,
+                        help="Number of pairs to print; all are written to similarity.csv.")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="Number of processes used to fingerprint files.")
+    args = parser.parse_args()
+    if args.baseline_dir is None:
+        print("Warning: without a baseline (-b), the starter code counts as shared code.",
+              file=sys.stderr)
+    main(args)
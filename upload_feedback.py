@@ -3,15 +3,13 @@
 
 import argparse
 import os
-import pickle
+import string
 # import yatl
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.http import MediaIoBaseDownload
-
+import api_metrics
 from file_distributor import FileDistributor
+from google_services import build_service, get_credentials, print_timing
+from sheet_reader import SheetReader, column_letter
 
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly',
@@ -19,49 +17,102 @@ SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly',
 # https://www.googleapis.com/auth/spreadsheets for r/w
 
 
+class FeedbackTemplate(object):
+    """A feedback template, parsed once and rendered for many rows.
+    The template uses the str.format syntax, with {column_name} referring
+    to a column called 'column name'."""
+
+    def __init__(self, text):
+        self.formatter = string.Formatter()
+        self.parts = list(self.formatter.parse(text))
+
+    def fields(self):
+        """Returns the set of names the template refers to."""
+        names = set()
+        for _, field_name, format_spec, _ in self.parts:
+            if field_name is not None:
+                # Keeps only the name in expressions like {name.attr} or {name[0]}.
+                names.add(field_name.split('.')[0].split('[')[0])
+            if format_spec:
+                names.update(FeedbackTemplate(format_spec).fields())
+        return names
+
+    def render(self, values):
+        """Renders the template with the dictionary values."""
+        out = []
+        for literal, field_name, format_spec, conversion in self.parts:
+            out.append(literal)
+            if field_name is None:
+                continue
+            value, _ = self.formatter.get_field(field_name, (), values)
+            value = self.formatter.convert_field(value, conversion)
+            if format_spec and '{' in format_spec:
+                format_spec = format_spec.format_map(values)
+            out.append(format(value, format_spec or ''))
+        return ''.join(out)
+
+
+def header_keys(headers):
+    """Returns the template key of each header."""
+    return [h.strip().replace(' ', '_') for h in headers]
+
+
+def check_template(template, headers):
+    """Checks that the template refers only to existing columns,
+    returning False (and printing why) if it does not.  Columns are
+    referred to by their key, with spaces replaced by underscores."""
+    keys = set(header_keys(headers))
+    fields = template.fields()
+    missing = sorted(f for f in fields if f not in keys)
+    if '' in missing or any(f.isdigit() for f in missing):
+        print("The template cannot use positional fields such as {} or {0}.")
+        return False
+    if missing:
+        print(f"The template refers to {missing}, which are not columns of the sheet.")
+        print(f"The available columns are {sorted(header_keys(headers))}")
+        return False
+    unused = [h for h, k in zip(headers, header_keys(headers)) if k not in fields]
+    if unused:
+        print(f"Note: the template does not use the columns {unused}")
+    return True
+
+
+def render_rows(template, headers, rows, email_column, students=None):
+    """Renders the feedback for each row, yielding pairs (email, text)."""
+    keys = header_keys(headers)
+    empty = {k: "" for k in keys}
+    for row in rows:
+        email = row[email_column] if email_column < len(row) else None
+        if email is None or '@' not in email:
+            continue
+        # We only process the required students. 
+        if students is not None and email not in students:
+            continue
+        d = dict(empty)
+        d.update(zip(keys, row))
+        yield email, template.render(d)
+
+
 def main(args):
-    creds = None
-    # The file token.pickle stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-            except:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    'credentials.json', SCOPES)
-                creds = flow.run_local_server()
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server()
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-
-    sheet_service = build('sheets', 'v4', credentials=creds)
-    drive_service = build('drive', 'v3', credentials=creds)
-
-    # Call the Sheets API
-    range_name = args.sheet
-    sheet = sheet_service.spreadsheets()
-    result = sheet.values().get(spreadsheetId=args.spreadsheet_id,
-                                range=range_name).execute()
-    values = result.get('values', [])
-
-    if not values or len(values) == 1:
+    creds = get_credentials(SCOPES)
+
+    sheet_service = build_service('sheets', 'v4', creds)
+    drive_service = build_service('drive', 'v3', creds)
+    if args.timing:
+        print_timing()
+
+    # Reads the headers, and then only the columns we need.
+    reader = SheetReader(sheet_service, args.spreadsheet_id, args.sheet)
+    headers = reader.headers()
+    if not headers:
         print('No data found.')
         return
     
     # Creates the file distributor.
-    file_distributor = FileDistributor(drive_service, args.destination_dir)
+    file_distributor = FileDistributor(
+        drive_service, args.destination_dir, index_file=args.index_file,
+        service_factory=lambda: build_service('drive', 'v3', creds))
     
-    headers = values[0]
     # Computes reverse index of header to column.
     header2column = {header: i for i, header in enumerate(headers)}
     # Figures out which column is the email. 
@@ -76,25 +127,49 @@ def main(args):
             return
         
     # Produces the text. 
-    for row in values[1:]:
-        email = row[email_column]
-        if email is None or '@' not in email:
-            continue
-        # We only process the required students. 
-        if args.students is not None and email not in args.students:
-            continue
-        d = {h: "" for h in headers}
-        d.update({headers[i].strip().replace(' ', '_') : row[i] for i in range(len(row))})
-        with open(args.feedback, 'r') as f:
-            text = f.read().format(**d)
-        if args.test:
+    with open(args.feedback, 'r') as f:
+        template = FeedbackTemplate(f.read())
+    if not check_template(template, headers):
+        return
+    fields = template.fields()
+    columns = [i for i, (h, k) in enumerate(zip(headers, header_keys(headers)))
+               if i == email_column or h in fields or k in fields]
+    rows = reader.read_columns([column_letter(i) for i in columns])
+    if not rows:
+        print('No data found.')
+        return
+    headers = [headers[i] for i in columns]
+    email_column = columns.index(email_column)
+    feedback = render_rows(template, headers, [row for _, row in rows], email_column, students=args.students)
+    if args.test:
+        for email, text in feedback:
             print("Feedback for", email, ":")
             print(text)
             break
-        # Shares the text. 
-        filename = f'feedback_{email}.txt'
-        file_distributor.distribute_bytes(
-            email, text.encode('utf-8'), filename, mime='text/plain', mode='reader', update=True)
+        return
+    if args.render_only is not None:
+        os.makedirs(args.render_only, exist_ok=True)
+        n = 0
+        for email, text in feedback:
+            with open(os.path.join(args.render_only, f'feedback_{email}.txt'), 'w') as f:
+                f.write(text)
+            n += 1
+        print(f"Rendered the feedback of {n} students in {args.render_only}")
+        return
+    items = [(email, text.encode('utf-8'), f'feedback_{email}.txt') for email, text in feedback]
+    api_metrics.metrics.students = len(items)
+    # Shares the text. 
+    if items:
+        if args.workers > 1 or args.journal is not None:
+            results = file_distributor.distribute_concurrently(
+                items, mime='text/plain', mode='reader', update=True,
+                workers=args.workers, qps=args.qps, journal_file=args.journal)
+        else:
+            results = file_distributor.distribute_many(
+                items, mime='text/plain', mode='reader', update=True)
+        failed = [email for (email, _, _), error in zip(items, results) if error is not None]
+        if failed:
+            print(f"Could not share feedback with {failed}")
     print("Done.")
 
 
@@ -110,9 +185,25 @@ if __name__ == '__main__':
                         help='Column containing email, if title is not email')
     parser.add_argument('-d', '--destination_dir', type=str, default=None, 
                         help='Destination folder ID in Drive for the feedback')
+    parser.add_argument('--index_file', type=str, default=None,
+                        help='File where to keep the index of the destination folder across runs')
     parser.add_argument('-t', '--test', action='store_true', default=False,
                         help="Test but do not share anything")
     parser.add_argument('--students', type=str, default=None,
                         help='Comma-separated list of student emails whose feedback we want to share')
+    parser.add_argument('--render-only', dest='render_only', type=str, default=None, metavar='DIR',
+                        help='Write the feedback to files in DIR rather than sharing it')
+    parser.add_argument('--timing', action='store_true', default=False,
+                        help='Print the time taken to load the credentials and services')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of feedback files to share concurrently')
+    parser.add_argument('--qps', type=float, default=5.0,
+                        help='Maximum number of Drive requests per second, with --workers')
+    parser.add_argument('--journal', type=str, default=None,
+                        help='File recording the feedback already shared, so that an '
+                        'interrupted run can be resumed')
+    api_metrics.add_arguments(parser)
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    api_metrics.start(args)
+    main(args)
+    api_metrics.finish(args)
\ No newline at end of file